@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WebikwaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webikwa257'
+
+    def ready(self):
+        from . import signals  # noqa: F401
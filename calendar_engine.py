@@ -0,0 +1,330 @@
+"""
+The calendar query engine used by IcalendarPage and IcalCombinerPage
+Events are read from the stored occurrences or expanded from the event snapshots, blocked UIDs are dropped, links are
+resolved, and the events are returned in order of start, optionally grouped by UID
+"""
+import heapq
+import itertools
+import zoneinfo
+
+import recurring_ical_events
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from .ical import (
+    CalendarEvent,
+    CalendarEventGroup,
+    get_occurrence_values,
+    snapshot_to_calendar,
+    to_datetime,
+)
+
+OVERLAY_RELATIONS = ("uid_links", "ical_events", "uid_blocks")
+
+
+def get_timezone():
+
+    return settings.TIME_ZONE if hasattr(settings, "TIME_ZONE") else "Etc/UTC"
+
+
+def get_event_key(event):
+    return (event.start_dt, event.uid)
+
+
+def iter_expanded_occurrences(calendar, start, end, tz, uid_blocks=(), skip_before=None, uids=None, lazy=False):
+    """
+    Yields (start datetime, calendar, occurrence values) for the occurrences of a calendar between start and end in order of start
+    If lazy, occurrences are expanded from the event snapshot one at a time with after(), so a consumer that stops early
+    stops the expansion.  after() searches the calendar in shrinking steps and is much slower than between() over a whole
+    window, so it's only worth it when the consumer wants a few occurrences.  Otherwise the window is expanded at once
+    with between() and sorted
+    If uids is given, only those events are expanded
+    """
+    if uids is None:
+        ical_calendar = calendar.get_snapshot_calendar()
+    else:
+        ical_calendar = snapshot_to_calendar(calendar.get_event_snapshot(), uids)
+
+    if lazy:
+        occurrences = (
+            (to_datetime(values["start"], tz), values)
+            for values in map(get_occurrence_values, recurring_ical_events.of(ical_calendar).after(start))
+        )
+    else:
+        occurrences = sorted(
+            (
+                (to_datetime(values["start"], tz), values)
+                for values in map(get_occurrence_values, recurring_ical_events.of(ical_calendar).between(start, end))
+            ),
+            key=lambda occurrence: occurrence[0],
+        )
+
+    for occurrence_start, values in occurrences:
+        if occurrence_start >= end:
+            return
+        if values["uid"] in uid_blocks:
+            continue
+        if skip_before is not None and occurrence_start < skip_before:
+            continue
+        yield occurrence_start, calendar, values
+
+
+def iter_calendar_occurrences(calendars, start, end, count=None, uid_blocks=None, uids=None, lazy=False):
+    """
+    Yields (start datetime, calendar, occurrence values) for the occurrences of the calendars between start and end, in order of start
+    Stored occurrences are read with one query for every calendar whose stored horizon includes start.
+    Other calendars, and the part of the window after the stored horizon, are expanded from the event snapshots as
+    time-ordered streams which are merged with a heap
+    If count is given, no more than count stored occurrences are read, the part after the stored horizon is only
+    expanded if the stored occurrences don't already provide count occurrences, and the expansion is lazy so that it
+    stops when the consumer stops.  Without count, each calendar's part of the window is expanded at once, unless lazy is
+    given for a consumer which stops early without knowing how many occurrences it needs
+    If uids is given, only the occurrences of those events are read
+    """
+    from .models import IcalendarOccurrence
+
+    lazy = lazy or count is not None
+
+    tz = zoneinfo.ZoneInfo(get_timezone())
+    uid_blocks = uid_blocks or {}
+
+    stored_calendars = [
+        calendar
+        for calendar in calendars
+        if calendar.occurrences_start is not None
+        and calendar.occurrences_start <= start < calendar.occurrences_end
+    ]
+    calendars_by_pk = {calendar.pk: calendar for calendar in stored_calendars}
+
+    streams = []
+    if stored_calendars:
+        stored_end = min([end] + [calendar.occurrences_end for calendar in stored_calendars])
+        rows = (
+            IcalendarOccurrence.objects.filter(
+                icalendar__in=stored_calendars, start__lt=stored_end, end__gt=start
+            )
+            .order_by("start", "pk")
+        )
+        if uids is not None:
+            rows = rows.filter(uid__in=uids)
+        blocked = models.Q()
+        for calendar in stored_calendars:
+            if uid_blocks.get(calendar.pk):
+                blocked = blocked | models.Q(icalendar=calendar, uid__in=uid_blocks[calendar.pk])
+        if blocked:
+            rows = rows.exclude(blocked)
+        if count is not None:
+            rows = list(rows[:count])
+            expand_stored = len(rows) < count
+        else:
+            rows = rows.iterator()
+            expand_stored = True
+        streams.append(
+            (row.start, calendars_by_pk[row.icalendar_id], row.get_values(tz)) for row in rows
+        )
+        if stored_end < end and expand_stored:
+            for calendar in stored_calendars:
+                streams.append(
+                    iter_expanded_occurrences(
+                        calendar,
+                        stored_end,
+                        end,
+                        tz,
+                        uid_blocks.get(calendar.pk, ()),
+                        skip_before=stored_end,
+                        uids=uids,
+                        lazy=lazy,
+                    )
+                )
+
+    for calendar in calendars:
+        if calendar.pk not in calendars_by_pk:
+            streams.append(
+                iter_expanded_occurrences(
+                    calendar, start, end, tz, uid_blocks.get(calendar.pk, ()), uids=uids, lazy=lazy
+                )
+            )
+
+    return heapq.merge(*streams, key=lambda occurrence: occurrence[0])
+
+
+def get_calendar_occurrences(calendars, start, end, count=None, uid_blocks=None):
+    """
+    Returns (calendar, occurrence values) pairs for no more than count occurrences of the calendars between start and end, in order of start
+    """
+    return [
+        (calendar, values)
+        for occurrence_start, calendar, values in itertools.islice(
+            iter_calendar_occurrences(calendars, start, end, count, uid_blocks), count
+        )
+    ]
+
+
+def get_calendars(queryset):
+    """
+    Returns the calendars of a queryset with their links, local events, and blocks prefetched, so that the overlays of
+    any number of calendars are read with one query for each relation
+    """
+    return list(queryset.prefetch_related(*OVERLAY_RELATIONS))
+
+
+def get_calendar_overlays(calendars):
+    """
+    Returns the links ({calendar pk: {uid: url}}) and blocks ({calendar pk: {uid}}) set on the calendars
+    """
+    uidlinks = {}
+    uidblocks = {}
+    for calendar in calendars:
+        uidlinks[calendar.pk] = {link.uid: link.url for link in calendar.uid_links.all()}
+        uidlinks[calendar.pk].update(
+            (ical_event.uid, ical_event.url) for ical_event in calendar.ical_events.all()
+        )
+        uidblocks[calendar.pk] = {block.uid for block in calendar.uid_blocks.all() if block.uid > ""}
+
+    return uidlinks, uidblocks
+
+
+def iter_events(calendars, window, limit=None, overlays=None, uids=None, lazy=False):
+    """
+    Yields CalendarEvent objects for the occurrences of the calendars within the window (start, end), in order of start
+    If limit is given, the stored occurrences read are limited to it, but the consumer is expected to stop after limit events
+    If uids is given, only the occurrences of those events are yielded
+    If lazy is given, the occurrences are expanded as they're consumed, as they are with limit
+    """
+    calendars = list(calendars)
+    start, end = window
+    tz = zoneinfo.ZoneInfo(get_timezone())
+    uidlinks, uidblocks = overlays or get_calendar_overlays(calendars)
+    calendar_urls = {calendar.pk: calendar.get_url() for calendar in calendars}
+
+    for occurrence_start, calendar, values in iter_calendar_occurrences(
+        calendars, start, end, limit, uidblocks, uids, lazy
+    ):
+        uid = values["uid"]
+        yield CalendarEvent(
+            uid,
+            calendar.slug,
+            calendar_urls[calendar.pk],
+            values["start"],
+            values["end"],
+            values["summary"],
+            values["description"],
+            uidlinks[calendar.pk].get(uid, ""),
+            tz,
+        )
+
+
+def group_events(events):
+    """
+    Returns CalendarEventGroup objects for the events grouped by UID, in order of the date of each group's first start
+    """
+    groups = {}
+    for event in events:
+        if event.uid not in groups:
+            groups[event.uid] = CalendarEventGroup(event)
+        else:
+            groups[event.uid].add(event)
+
+    for group in groups.values():
+        group.starts.sort()
+    return sorted(groups.values(), key=lambda group: group.start_d)
+
+
+def events(calendars, window, limit=None, group_by_uid=False):
+    """
+    Returns no more than limit CalendarEvent objects for the occurrences of the calendars within the window (start, end) in order of start
+    With group_by_uid, returns CalendarEventGroup objects for the first limit events to start in the window instead,
+    each holding every start of its event in the window
+    """
+    if group_by_uid:
+        return grouped_events(calendars, window, limit)
+    return list(itertools.islice(iter_events(calendars, window, limit), limit))
+
+
+def grouped_events(calendars, window, limit=None):
+    """
+    Returns CalendarEventGroup objects for the first limit UIDs to start in the window (start, end), in order of first start
+    The window is read lazily until limit UIDs are found, and then only the occurrences of those UIDs are read for the rest
+    of it, so that an event which repeats often doesn't crowd out the others, and each group has all of its starts in the window
+    """
+    calendars = list(calendars)
+    overlays = get_calendar_overlays(calendars)
+    if limit is None:
+        return group_events(iter_events(calendars, window, overlays=overlays))
+
+    uids = set()
+    for event in iter_events(calendars, window, overlays=overlays, lazy=True):
+        uids.add(event.uid)
+        if len(uids) >= limit:
+            break
+    if not uids:
+        return []
+    return group_events(iter_events(calendars, window, overlays=overlays, uids=uids))
+
+
+def events_page(calendars, window, page_size, after=None, before=None):
+    """
+    Returns a page of CalendarEvent objects from the window (start, end), ordered by start and uid
+    The page holds the first page_size events after the cursor (start, uid) after, or the last page_size events before the
+    cursor before.  Without a cursor, the page holds the first page_size events of the window
+    """
+    if before is not None:
+        page = [
+            event for event in iter_events(calendars, window) if get_event_key(event) < before
+        ]
+        page.sort(key=get_event_key)
+        return page[-page_size:]
+
+    page = []
+    for event in iter_events(calendars, window):
+        if after is not None and get_event_key(event) <= after:
+            continue
+        if len(page) >= page_size and event.start_dt > page[-1].start_dt:
+            break
+        page.append(event)
+    page.sort(key=get_event_key)
+    return page[:page_size]
+
+
+def uid_events(calendar, uid, limit):
+    """
+    Returns the next limit CalendarEvent objects of a single event of a calendar, without reading the rest of the calendar
+    The stored occurrences are looked up by UID. If none are upcoming, only that event is expanded from its snapshot entry,
+    and if it has no upcoming occurrences at all, its latest stored occurrence is returned
+    """
+    uidlinks, uidblocks = get_calendar_overlays([calendar])
+    if uid in uidblocks[calendar.pk]:
+        return []
+    tz = zoneinfo.ZoneInfo(get_timezone())
+    now = timezone.now()
+
+    occurrences = [
+        row.get_values(tz)
+        for row in calendar.occurrences.filter(uid=uid, end__gt=now).order_by("start")[:limit]
+    ]
+    if not occurrences and uid in calendar.get_event_snapshot()["events"]:
+        ical_calendar = snapshot_to_calendar(calendar.get_event_snapshot(), {uid})
+        occurrences = [
+            get_occurrence_values(ical_event)
+            for ical_event in itertools.islice(recurring_ical_events.of(ical_calendar).after(now), limit)
+        ]
+    if not occurrences:
+        row = calendar.occurrences.filter(uid=uid).order_by("-start").first()
+        occurrences = [row.get_values(tz)] if row else []
+
+    calendar_url = calendar.get_url()
+    return [
+        CalendarEvent(
+            uid,
+            calendar.slug,
+            calendar_url,
+            values["start"],
+            values["end"],
+            values["summary"],
+            values["description"],
+            uidlinks[calendar.pk].get(uid, ""),
+            tz,
+        )
+        for values in occurrences
+    ]
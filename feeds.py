@@ -0,0 +1,123 @@
+"""
+Fetching of remote ics feeds for IcalendarPage
+"""
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where refreshes aren't locked
+    fcntl = None
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FeedResponse = collections.namedtuple("FeedResponse", ["text", "etag", "last_modified"])
+
+MAX_FEED_SIZE = 20 * 1024 * 1024
+
+
+def get_content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class FeedTooLarge(requests.RequestException):
+    pass
+
+
+def fetch_feed(url, etag="", last_modified="", session=None, timeout=(5, 30), max_size=MAX_FEED_SIZE):
+    """
+    Returns a FeedResponse for the feed at url, requested conditionally with the ETag and Last-Modified of the last response
+    text is None if the feed wasn't modified
+    timeout is (connect, read) in seconds.  The feed is streamed, and FeedTooLarge is raised once it's longer than max_size bytes
+    Error statuses are raised as requests.HTTPError, so that a failed request doesn't replace the data
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    with (session or requests).get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            return FeedResponse(None, etag, last_modified)
+        response.raise_for_status()
+
+        content = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            content.extend(chunk)
+            if len(content) > max_size:
+                raise FeedTooLarge("{} is larger than {} bytes".format(url, max_size))
+
+        # ics data is utf-8 unless the response says otherwise
+        encoding = response.encoding if "charset" in response.headers.get("Content-Type", "") else "utf-8"
+        return FeedResponse(
+            content.decode(encoding, errors="replace"),
+            response.headers.get("ETag", ""),
+            response.headers.get("Last-Modified", ""),
+        )
+
+
+def get_session(pool_size):
+    """
+    Returns a requests session that keeps up to pool_size connections open to each host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_feeds(sources, max_workers=8, **options):
+    """
+    Fetches feeds concurrently with up to max_workers threads sharing one session
+    sources is a dict of {url: (etag, last_modified)}, and options are passed to fetch_feed
+    Returns {url: (the FeedResponse or the exception raised while fetching, the seconds taken)}
+    """
+
+    def fetch(url, etag, last_modified):
+        started = time.monotonic()
+        try:
+            result = fetch_feed(url, etag, last_modified, session, **options)
+        except requests.RequestException as e:
+            result = e
+        return url, result, time.monotonic() - started
+
+    fetched = {}
+    with get_session(max_workers) as session, concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(fetch, url, etag, last_modified)
+            for url, (etag, last_modified) in sources.items()
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            url, result, seconds = future.result()
+            fetched[url] = (result, seconds)
+    return fetched
+
+
+@contextlib.contextmanager
+def feed_lock(lock_dir, name, blocking=True):
+    """
+    Holds an exclusive lock on the lock file for name in lock_dir, which is shared by every process on the host
+    Yields whether the lock was acquired, which is always True when blocking
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, "{}.lock".format(name)), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,456 @@
+import datetime
+import functools
+import hashlib
+import json
+import re
+import zoneinfo
+
+import icalendar
+import x_wr_timezone
+
+# Increase when the layout of the event snapshot changes.  Calendars with an older
+# snapshot are rebuilt from their data by the rebuild_calendars command
+SNAPSHOT_VERSION = 3
+
+
+def encode_date_or_datetime(value, tzid=None):
+    """
+    Encodes a date or datetime as a string for the event snapshot
+    Datetimes in a named zone keep the zone name so recurrences follow its daylight saving time rules.  tzid is the
+    TZID of a VTIMEZONE defined by the calendar, used for zones which aren't in the zoneinfo database
+    ex: "2024-05-01", "2024-05-01T10:00:00", "2024-05-01T10:00:00[America/New_York]", "2024-05-01T10:00:00[Eastern Standard Time]"
+    """
+    if not isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if value.tzinfo is None:
+        return value.isoformat()
+    if isinstance(value.tzinfo, zoneinfo.ZoneInfo):
+        return f"{ value.replace(tzinfo=None).isoformat() }[{ value.tzinfo.key }]"
+    if tzid:
+        return f"{ value.replace(tzinfo=None).isoformat() }[{ tzid }]"
+    return value.astimezone(datetime.timezone.utc).isoformat()
+
+
+def decode_date_or_datetime(value, timezones=None):
+    """
+    Decodes a date or datetime encoded by encode_date_or_datetime
+    timezones is a dict of {TZID: tzinfo} for the VTIMEZONEs of the calendar, from get_snapshot_timezones
+    """
+    if "[" in value:
+        value, zone_name = value[:-1].split("[", 1)
+        if timezones and zone_name in timezones:
+            tz = timezones[zone_name]
+        else:
+            tz = zoneinfo.ZoneInfo(zone_name)
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=tz)
+    if "T" in value:
+        return datetime.datetime.fromisoformat(value)
+    return datetime.date.fromisoformat(value)
+
+
+def get_property_tzid(prop, timezones):
+    tzid = prop.params.get("TZID")
+    return tzid if tzid in timezones else None
+
+
+def get_property_dates(component, name, timezones=()):
+    dates = []
+    values = component.get(name, [])
+    if not isinstance(values, list):
+        values = [values]
+    for value in values:
+        tzid = get_property_tzid(value, timezones)
+        for ddd in value.dts:
+            if isinstance(ddd.dt, (datetime.date, datetime.datetime)):
+                dates.append(encode_date_or_datetime(ddd.dt, tzid))
+    return dates
+
+
+def encode_property(vevent, name, timezones):
+    return encode_date_or_datetime(vevent[name].dt, get_property_tzid(vevent[name], timezones))
+
+
+def build_snapshot_entry(vevent, timezones=()):
+    """
+    Returns the snapshot entry for a VEVENT.  timezones holds the TZIDs of the VTIMEZONEs defined by the calendar
+    """
+    entry = {
+        "dtstart": encode_property(vevent, "DTSTART", timezones),
+        "summary": str(vevent.get("SUMMARY", "")),
+        "description": str(vevent.get("DESCRIPTION", "")),
+    }
+    if "DTEND" in vevent:
+        entry["dtend"] = encode_property(vevent, "DTEND", timezones)
+    elif "DURATION" in vevent:
+        entry["duration"] = vevent["DURATION"].dt.total_seconds()
+
+    rrules = vevent.get("RRULE", [])
+    if not isinstance(rrules, list):
+        rrules = [rrules]
+    if rrules:
+        entry["rrule"] = [rrule.to_ical().decode() for rrule in rrules]
+    for name in ["RDATE", "EXDATE"]:
+        dates = get_property_dates(vevent, name, timezones)
+        if dates:
+            entry[name.lower()] = dates
+    if "RECURRENCE-ID" in vevent:
+        entry["recurrence_id"] = encode_property(vevent, "RECURRENCE-ID", timezones)
+    if "SEQUENCE" in vevent:
+        entry["sequence"] = int(vevent["SEQUENCE"])
+    if "LAST-MODIFIED" in vevent:
+        entry["last_modified"] = encode_date_or_datetime(vevent["LAST-MODIFIED"].dt)
+
+    return entry
+
+
+def get_event_hash(event):
+    """
+    Returns a hash of a snapshot event, including its SEQUENCE, LAST-MODIFIED, and overrides, used to find events that changed
+    """
+    event = {key: value for key, value in event.items() if key != "hash"}
+    return hashlib.sha1(
+        json.dumps(event, sort_keys=True).encode(), usedforsecurity=False
+    ).hexdigest()
+
+
+def build_snapshot(ical_calendar):
+    """
+    Returns a compact, json serializable snapshot of the events in a parsed calendar, grouped by UID
+    Modified occurrences of a recurring event (those with a RECURRENCE-ID) are kept in the "overrides" list of their event
+    The VTIMEZONEs of the calendar are kept in "timezones", so that times in zones which aren't in the zoneinfo database
+    (such as Outlook's "Eastern Standard Time") keep their local time and daylight saving time rules
+    """
+    ical_calendar = x_wr_timezone.to_standard(ical_calendar)
+    timezones = {
+        str(vtimezone["TZID"]): vtimezone.to_ical().decode()
+        for vtimezone in ical_calendar.walk("VTIMEZONE")
+        if "TZID" in vtimezone
+    }
+    events = {}
+    for vevent in ical_calendar.walk("VEVENT"):
+        if "UID" not in vevent or "DTSTART" not in vevent:
+            continue
+        uid = str(vevent["UID"])
+        entry = build_snapshot_entry(vevent, timezones)
+        if "recurrence_id" in entry:
+            events.setdefault(uid, {"overrides": []})["overrides"].append(entry)
+        else:
+            events[uid] = {**entry, "overrides": events.get(uid, {}).get("overrides", [])}
+
+    for event in events.values():
+        event["hash"] = get_event_hash(event)
+
+    snapshot = {"version": SNAPSHOT_VERSION, "events": events}
+    if timezones:
+        snapshot["timezones"] = timezones
+    return snapshot
+
+
+def diff_snapshots(previous_snapshot, snapshot):
+    """
+    Returns the UIDs of the events that were added or changed, and the UIDs of the events that were removed
+    """
+    previous_events = previous_snapshot.get("events", {})
+    events = snapshot.get("events", {})
+    if previous_snapshot.get("timezones", {}) != snapshot.get("timezones", {}):
+        # the times of every event may have moved
+        return set(events), set(previous_events) - set(events)
+    changed_uids = {
+        uid
+        for uid, event in events.items()
+        if uid not in previous_events or previous_events[uid].get("hash") != event["hash"]
+    }
+    removed_uids = set(previous_events) - set(events)
+    return changed_uids, removed_uids
+
+
+def get_data_uids(data):
+    """
+    Returns the set of UIDs in ics data, found from the unfolded UID lines without parsing the rest of the data
+    """
+    unfolded = re.sub(r"\r?\n[ \t]", "", data)
+    return set(re.findall(r"^UID(?:;[^:\r\n]*)?:(.*?)\r?$", unfolded, re.MULTILINE))
+
+
+@functools.lru_cache(maxsize=64)
+def get_vtimezone_tz(vtimezone_ical):
+    return icalendar.Timezone.from_ical(vtimezone_ical).to_tz()
+
+
+def get_snapshot_timezones(snapshot):
+    """
+    Returns {TZID: tzinfo} for the VTIMEZONEs kept in a snapshot.  Each definition is only converted once per process
+    """
+    return {
+        tzid: get_vtimezone_tz(vtimezone_ical)
+        for tzid, vtimezone_ical in snapshot.get("timezones", {}).items()
+    }
+
+
+def build_vevent(uid, entry, timezones=None):
+    vevent = icalendar.Event()
+    vevent.add("UID", uid)
+    vevent.add("DTSTART", decode_date_or_datetime(entry["dtstart"], timezones))
+    if "dtend" in entry:
+        vevent.add("DTEND", decode_date_or_datetime(entry["dtend"], timezones))
+    elif "duration" in entry:
+        vevent.add("DURATION", datetime.timedelta(seconds=entry["duration"]))
+    if entry["summary"]:
+        vevent.add("SUMMARY", entry["summary"])
+    if entry["description"]:
+        vevent.add("DESCRIPTION", entry["description"])
+    for rrule in entry.get("rrule", []):
+        vevent.add("RRULE", icalendar.vRecur.from_ical(rrule))
+    for name in ["rdate", "exdate"]:
+        if name in entry:
+            vevent.add(
+                name.upper(),
+                [decode_date_or_datetime(value, timezones) for value in entry[name]],
+            )
+    if "recurrence_id" in entry:
+        vevent.add("RECURRENCE-ID", decode_date_or_datetime(entry["recurrence_id"], timezones))
+
+    return vevent
+
+
+def snapshot_to_calendar(snapshot, uids=None):
+    """
+    Rebuilds an icalendar.Calendar from a snapshot without parsing ics text
+    If uids is given, only those events are included
+    """
+    ical_calendar = icalendar.Calendar()
+    timezones = get_snapshot_timezones(snapshot)
+    for uid, event in snapshot.get("events", {}).items():
+        if uids is not None and uid not in uids:
+            continue
+        if "dtstart" in event:
+            ical_calendar.add_component(build_vevent(uid, event, timezones))
+        for override in event["overrides"]:
+            ical_calendar.add_component(build_vevent(uid, override, timezones))
+
+    return ical_calendar
+
+
+def to_datetime(value, tz):
+    """
+    Returns an aware datetime for a date (at midnight), a floating datetime, or an aware datetime in the given zone
+    """
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day, tzinfo=tz)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=tz)
+    return value
+
+
+def get_occurrence_values(ical_event):
+    """
+    Returns the values of an expanded occurrence as a dict with uid, start, end, summary, and description
+    All day occurrences have dates for start and end
+    """
+    start = ical_event["DTSTART"].dt
+    end = ical_event["DTEND"].dt if "DTEND" in ical_event else start
+    return {
+        "uid": str(ical_event["UID"]),
+        "start": start,
+        "end": end,
+        "summary": str(ical_event.get("SUMMARY", "")),
+        "description": str(ical_event.get("DESCRIPTION", "")),
+    }
+
+
+class DateRange:
+    """
+    A lazy sequence of the days in a window, used instead of a list of every day so that only the days which are displayed are created
+    Items have the same type as start (a date or a datetime), one day apart
+    """
+
+    def __init__(self, start, days):
+        self.start = start
+        self.days = max(days, 0)
+
+    def __len__(self):
+        return self.days
+
+    def __iter__(self):
+        for i in range(self.days):
+            yield self.start + datetime.timedelta(days=i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            first, last, step = index.indices(self.days)
+            if step != 1:
+                return list(self)[index]
+            return DateRange(self.start + datetime.timedelta(days=first), last - first)
+        if index < 0:
+            index = index + self.days
+        if not 0 <= index < self.days:
+            raise IndexError("DateRange index out of range")
+        return self.start + datetime.timedelta(days=index)
+
+    def __bool__(self):
+        return self.days > 0
+
+    @property
+    def end(self):
+        return self.start + datetime.timedelta(days=self.days)
+
+    def months(self):
+        """
+        Returns (year, month) for each month in the range
+        """
+        if not self.days:
+            return []
+        last = self.end - datetime.timedelta(days=1)
+        months = []
+        year, month = self.start.year, self.start.month
+        while (year, month) <= (last.year, last.month):
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+    def for_month(self, year, month):
+        """
+        Returns the part of the range in the given month
+        """
+        month_start = datetime.date(year, month, 1)
+        month_end = datetime.date(year + 1, 1, 1) if month == 12 else datetime.date(year, month + 1, 1)
+        start_date = self.start.date() if isinstance(self.start, datetime.datetime) else self.start
+        first = max((month_start - start_date).days, 0)
+        last = min((month_end - start_date).days, self.days)
+        return self[first:max(first, last)]
+
+
+def get_local_date(value, tz):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(tz)
+        return value.date()
+    return value
+
+
+def bucket_events_by_date(events, dates, tz):
+    """
+    Returns a list with {"date": ..., "events": [...]} for each of dates, holding the events on that local date
+    Events which last more than one day are included on each day they cover.  All day events end the day before their end date
+    Events are bucketed in one pass without comparing each day with each event
+    """
+    if not dates:
+        return []
+    first_date = get_local_date(dates[0], tz)
+    buckets = [[] for i in range(len(dates))]
+    for event in events:
+        start_date = get_local_date(event.start, tz)
+        end = event.end
+        if isinstance(end, datetime.datetime):
+            end_date = get_local_date(end - datetime.timedelta(microseconds=1), tz)
+        else:
+            end_date = end - datetime.timedelta(days=1)
+        end_date = max(start_date, end_date)
+
+        first = max((start_date - first_date).days, 0)
+        last = min((end_date - first_date).days, len(buckets) - 1)
+        for i in range(first, last + 1):
+            buckets[i].append(event)
+
+    return [{"date": date, "events": bucket} for date, bucket in zip(dates, buckets)]
+
+
+def get_occurrence_cursor(occurrence_start, uid):
+    return "{},{}".format(
+        occurrence_start.astimezone(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ"), uid
+    )
+
+
+def parse_occurrence_cursor(cursor):
+    """
+    Returns (start datetime, uid) from a cursor made by get_occurrence_cursor, or None if the cursor is invalid
+    """
+    try:
+        cursor_start, uid = cursor.split(",", 1)
+        return (
+            datetime.datetime.strptime(cursor_start, "%Y%m%dT%H%M%SZ").replace(
+                tzinfo=datetime.timezone.utc
+            ),
+            uid,
+        )
+    except ValueError:
+        return None
+
+
+class CalendarEvent:
+    """
+    An occurrence of an event as given to the calendar templates
+    The variants of start used by the templates (start_type, start_d, start_dt) are computed when they're read instead of being stored for each occurrence
+    """
+
+    __slots__ = (
+        "uid",
+        "calendar_slug",
+        "calendar",
+        "start",
+        "end",
+        "summary",
+        "description",
+        "link",
+        "tz",
+    )
+
+    def __init__(self, uid, calendar_slug, calendar, start, end, summary, description, link, tz):
+        self.uid = uid
+        self.calendar_slug = calendar_slug
+        self.calendar = calendar
+        self.start = start
+        self.end = end
+        self.summary = summary
+        self.description = description
+        self.link = link
+        self.tz = tz
+
+    @property
+    def start_type(self):
+        return type(self.start).__name__
+
+    @property
+    def start_d(self):
+        return self.start.date() if isinstance(self.start, datetime.datetime) else self.start
+
+    @property
+    def start_dt(self):
+        return to_datetime(self.start, self.tz)
+
+
+class CalendarEventGroup:
+    """
+    The occurrences of one event, showing the first occurrence's details with the start of the earliest occurrence and a list of all starts
+    """
+
+    __slots__ = ("event", "starts")
+
+    def __init__(self, event):
+        self.event = event
+        self.starts = [event.start]
+
+    def __getattr__(self, name):
+        if name == "event":
+            raise AttributeError(name)
+        return getattr(self.event, name)
+
+    def add(self, event):
+        self.starts.append(event.start)
+
+    @property
+    def start(self):
+        return min(self.starts)
+
+    @property
+    def start_type(self):
+        return type(self.start).__name__
+
+    @property
+    def start_d(self):
+        start = self.start
+        return start.date() if isinstance(start, datetime.datetime) else start
+
+    @property
+    def start_dt(self):
+        return to_datetime(self.start, self.event.tz)
@@ -0,0 +1,99 @@
+import datetime
+import statistics
+import timeit
+import zoneinfo
+
+import icalendar
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from webikwa257.calendar_engine import events, get_timezone
+from webikwa257.ical import DateRange, bucket_events_by_date, build_snapshot, snapshot_to_calendar
+from webikwa257.models import IcalendarPage
+
+
+def get_benchmark_ics(name, event_qty):
+    """
+    Returns ics data with event_qty events, a quarter of them weekly, a quarter daily, and the rest single events over the next year
+    """
+    now = timezone.now().replace(minute=0, second=0, microsecond=0)
+    vevents = []
+    for i in range(event_qty):
+        start = now + datetime.timedelta(days=i % 365, hours=i % 10)
+        rrule = ""
+        if i % 4 == 0:
+            rrule = "RRULE:FREQ=WEEKLY\n"
+        elif i % 4 == 1:
+            rrule = "RRULE:FREQ=DAILY;COUNT=30\n"
+        vevents.append(
+            "BEGIN:VEVENT\n"
+            f"UID:{i}@{name}\n"
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%SZ')}\n"
+            f"DTEND:{(start + datetime.timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ')}\n"
+            f"{rrule}"
+            f"SUMMARY:Event {i}\n"
+            "END:VEVENT\n"
+        )
+    return "BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//benchmark//EN\n{}END:VCALENDAR\n".format("".join(vevents))
+
+
+class Command(BaseCommand):
+    help = 'Times the calendar engine on generated calendars, or on stored Icalendar pages when page ids are given.  Generated calendars are not saved, so their events are expanded from the snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('page_ids', nargs='*', type=int)
+        parser.add_argument('--calendars', type=int, default=2, help='The number of generated calendars')
+        parser.add_argument('--events', type=int, default=50, help='The number of events in each generated calendar')
+        parser.add_argument('--days', type=int, default=90, help='The number of days in the window')
+        parser.add_argument('--limit', type=int, default=10, help='The limit for the limited runs')
+        parser.add_argument('--combiner-days', type=int, default=3660, help='The span of the combiner window, which is read without a limit as by a combiner with the default start,span,count')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def time(self, label, func, repeat):
+        timings = timeit.repeat(func, number=1, repeat=repeat)
+        self.stdout.write('{:<32} min {:>9.2f}ms  median {:>9.2f}ms'.format(
+            label, min(timings) * 1000, statistics.median(timings) * 1000
+        ))
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        if options['page_ids']:
+            calendars = list(IcalendarPage.objects.filter(pk__in=options['page_ids']))
+        else:
+            calendars = []
+            for i in range(options['calendars']):
+                calendar = IcalendarPage(
+                    title='Benchmark {}'.format(i),
+                    slug='benchmark-{}'.format(i),
+                    data=get_benchmark_ics('benchmark-{}'.format(i), options['events']),
+                )
+                calendar.rebuild_event_snapshot()
+                calendars.append(calendar)
+
+            ical_calendar = icalendar.Calendar.from_ical(calendars[0].data)
+            self.time('parse', lambda: icalendar.Calendar.from_ical(calendars[0].data), repeat)
+            self.time('build snapshot', lambda: build_snapshot(ical_calendar), repeat)
+            self.time('snapshot to calendar', lambda: snapshot_to_calendar(calendars[0].event_snapshot), repeat)
+
+        tz = zoneinfo.ZoneInfo(get_timezone())
+        now = timezone.now()
+        window = (now, now + datetime.timedelta(days=options['days']))
+        limit = options['limit']
+
+        self.time('events, limit {}'.format(limit), lambda: events(calendars, window, limit), repeat)
+        self.time('events', lambda: events(calendars, window), repeat)
+        self.time('events grouped by uid', lambda: events(calendars, window, group_by_uid=True), repeat)
+        self.time('events grouped, limit {}'.format(limit), lambda: events(calendars, window, limit, group_by_uid=True), repeat)
+
+        # a combiner with the default "-1,3660" reads its whole window without a count
+        combiner_window = (now - datetime.timedelta(days=1), now + datetime.timedelta(days=options['combiner_days']))
+        self.time('events, {} days, no limit'.format(options['combiner_days']), lambda: events(calendars, combiner_window), repeat)
+
+        month_dates = DateRange(timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0), 31)
+        month_window = (month_dates[0], month_dates.end)
+        month_events = events(calendars, month_window)
+        self.time('month events', lambda: events(calendars, month_window), repeat)
+        self.time('bucket month by date', lambda: bucket_events_by_date(month_events, month_dates, tz), repeat)
+
+        self.stdout.write(self.style.SUCCESS('{} events in the window, {} in the month'.format(
+            len(events(calendars, window)), len(month_events)
+        )))
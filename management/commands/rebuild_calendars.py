@@ -0,0 +1,34 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from webikwa257.ical import SNAPSHOT_VERSION
+from webikwa257.models import IcalendarPage
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Rebuilds the stored occurrences of Icalendar pages for the current horizon without fetching the source, along with event snapshots made with an older snapshot version.  This can be run daily to roll the horizon forward for calendars without a source, whose horizons aren\'t rolled by refresh_calendars'
+
+    def add_arguments(self, parser):
+        parser.add_argument('page_ids', nargs='*', type=int)
+        parser.add_argument('--all', action='store_true', help='Rebuild every snapshot, even if it is current')
+
+    def handle(self, *args, **options):
+        pages = IcalendarPage.objects.all()
+        if options['page_ids']:
+            pages = pages.filter(pk__in=options['page_ids'])
+
+        rebuilt = 0
+        for page in pages.iterator():
+            with transaction.atomic():
+                page.lock_for_update()
+                page.reload_feed()
+                previous_snapshot = page.event_snapshot
+                if options['all'] or previous_snapshot.get('version') != SNAPSHOT_VERSION:
+                    page.rebuild_event_snapshot()
+                    rebuilt = rebuilt + 1
+                page.update_occurrences(previous_snapshot)
+                page.save_event_snapshot()
+
+        self.stdout.write(self.style.SUCCESS('Rebuilt %s calendar snapshots' % rebuilt))
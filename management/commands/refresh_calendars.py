@@ -0,0 +1,57 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+from webikwa257.models import IcalendarFeed, IcalendarPage, refresh_icalendar_pages
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Refreshes Icalendar pages from their sources when they are due, as set by each page\'s refresh interval.  With --loop, keeps running as a worker, waking when the next calendar is due.  ex: \'python manage.py refresh_calendars --loop\''
+
+    def add_arguments(self, parser):
+        parser.add_argument('page_ids', nargs='*', type=int)
+        parser.add_argument('--force', action='store_true', help='Refresh the pages even if they are not due')
+        parser.add_argument('--loop', action='store_true', help='Keep running, refreshing pages as they become due')
+        parser.add_argument('--workers', type=int, default=8, help='The most sources to fetch at a time')
+        parser.add_argument('--max-sleep', type=int, default=60, help='The most seconds to wait between checks for due pages when looping')
+
+    def get_pages(self, options):
+        pages = IcalendarPage.objects.exclude(source='')
+        if options['page_ids']:
+            pages = pages.filter(pk__in=options['page_ids'])
+        if not options['force']:
+            pages = pages.filter(
+                models.Q(feed__isnull=True)
+                | models.Q(feed__next_refresh_at__isnull=True)
+                | models.Q(feed__next_refresh_at__lte=timezone.now())
+            )
+        return pages
+
+    def refresh(self, options):
+        pages = list(self.get_pages(options))
+        refreshed = refresh_icalendar_pages(pages, options['workers'])
+        for source, (source_pages, fetched, seconds) in refreshed.items():
+            logger.info('Refreshed %s for pages %s in %.2fs' % (
+                source, ', '.join(str(page.pk) for page in source_pages), seconds
+            ))
+        return len(pages)
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            refreshed = self.refresh(options)
+            self.stdout.write(self.style.SUCCESS('Refreshed %s calendars' % refreshed))
+            return
+
+        options['force'] = False
+        while True:
+            self.refresh(options)
+            next_refresh_at = IcalendarFeed.objects.exclude(icalendar__source='').aggregate(
+                models.Min('next_refresh_at')
+            )['next_refresh_at__min']
+            sleep = options['max_sleep']
+            if next_refresh_at is not None:
+                sleep = min(sleep, max((next_refresh_at - timezone.now()).total_seconds(), 1))
+            time.sleep(sleep)
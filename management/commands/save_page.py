@@ -1,24 +1,40 @@
 import logging
 
 from django.core.management.base import BaseCommand, CommandError
-from webikwa257.models import IcalendarPage
+from webikwa257.models import IcalendarPage, refresh_icalendar_pages
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    help = 'Auto saves pages - this is useful for Icalendar pages. ex: \'python manage.py save_page 86 47\' saves pages with ids 86 and 47'
+    help = 'Auto saves pages - this is useful for Icalendar pages. ex: \'python manage.py save_page 86 47\' saves pages with ids 86 and 47.  The sources of Icalendar pages are fetched concurrently, once for each distinct source'
 
     def add_arguments(self, parser):
         parser.add_argument('page_ids', nargs='+', type=int)
+        parser.add_argument('--workers', type=int, default=8, help='The most sources to fetch at a time')
 
     def handle(self, *args, **options):
+        pages = []
         for page_id in options['page_ids']:
             try:
                 page = IcalendarPage.objects.get(pk=page_id)
-            except page.DoesNotExist:
+            except IcalendarPage.DoesNotExist:
                 raise CommandError('Page "%s" does not exist' % page_id)
 
-            page.save() #Icalendar pages will rewrite their data upon save
+            page.save()
+            pages.append(page)
+
+        #Icalendar pages will rewrite their data from the source
+        refreshed = refresh_icalendar_pages([page for page in pages if page.source], options['workers'])
+        for source, (source_pages, fetched, seconds) in refreshed.items():
+            if isinstance(fetched, Exception):
+                status = 'failed (%s)' % fetched
+            elif fetched.text is None:
+                status = 'not modified'
+            else:
+                status = 'fetched %s characters' % len(fetched.text)
+            self.stdout.write('%s for pages %s: %s in %.2fs' % (
+                source, ', '.join(str(page.pk) for page in source_pages), status, seconds
+            ))
 
 #            logger.info('Successfully upated page "%s"' % page_id)
 
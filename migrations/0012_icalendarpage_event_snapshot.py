@@ -0,0 +1,18 @@
+# Generated by Django 6.0.4 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0011_sitetemplatesettings_after_article'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarpage',
+            name='event_snapshot',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text="The events parsed from the data, stored so that the data doesn't need to be parsed for each request", verbose_name='event snapshot'),
+        ),
+    ]
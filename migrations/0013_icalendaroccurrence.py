@@ -0,0 +1,41 @@
+# Generated by Django 6.0.4 on 2026-10-18 15:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0012_icalendarpage_event_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarpage',
+            name='occurrences_end',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='occurrences end'),
+        ),
+        migrations.AddField(
+            model_name='icalendarpage',
+            name='occurrences_start',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='occurrences start'),
+        ),
+        migrations.CreateModel(
+            name='IcalendarOccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.CharField(max_length=255)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('all_day', models.BooleanField(default=False)),
+                ('summary', models.TextField(blank=True)),
+                ('description', models.TextField(blank=True)),
+                ('icalendar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='webikwa257.icalendarpage')),
+            ],
+            options={
+                'ordering': ('start',),
+                'indexes': [models.Index(fields=['icalendar', 'start'], name='webikwa257__icalend_acffee_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.4 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0013_icalendaroccurrence'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='icalendaroccurrence',
+            index=models.Index(fields=['icalendar', 'uid', 'start'], name='webikwa257__icalend_91e8ef_idx'),
+        ),
+    ]
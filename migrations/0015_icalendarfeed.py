@@ -0,0 +1,41 @@
+# Generated by Django 6.0.4 on 2026-10-18 15:50
+
+import django.db.models.deletion
+import webikwa257.models
+from django.db import migrations, models
+
+
+def copy_data_to_feeds(apps, schema_editor):
+    IcalendarPage = apps.get_model('webikwa257', 'IcalendarPage')
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for page in IcalendarPage.objects.only('pk', 'data').iterator():
+        IcalendarFeed.objects.create(icalendar_id=page.pk, data=page.data)
+
+
+def copy_feeds_to_data(apps, schema_editor):
+    IcalendarPage = apps.get_model('webikwa257', 'IcalendarPage')
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for feed in IcalendarFeed.objects.iterator():
+        IcalendarPage.objects.filter(pk=feed.icalendar_id).update(data=feed.data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0014_icalendaroccurrence_uid_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IcalendarFeed',
+            fields=[
+                ('icalendar', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='feed', serialize=False, to='webikwa257.icalendarpage')),
+                ('data', models.TextField(blank=True, default=webikwa257.models.get_empty_ical)),
+            ],
+        ),
+        migrations.RunPython(copy_data_to_feeds, copy_feeds_to_data),
+        migrations.RemoveField(
+            model_name='icalendarpage',
+            name='data',
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0.4 on 2026-10-18 16:02
+
+import webikwa257.models
+import zlib
+from django.db import migrations, models
+
+
+def compress_feeds(apps, schema_editor):
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for feed in IcalendarFeed.objects.iterator():
+        feed.compressed_data = zlib.compress(feed.data.encode('utf-8'))
+        feed.save(update_fields=['compressed_data'])
+
+
+def decompress_feeds(apps, schema_editor):
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for feed in IcalendarFeed.objects.iterator():
+        feed.data = zlib.decompress(bytes(feed.compressed_data)).decode('utf-8')
+        feed.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0015_icalendarfeed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='compressed_data',
+            field=models.BinaryField(blank=True, default=webikwa257.models.get_empty_compressed_ical),
+        ),
+        migrations.RunPython(compress_feeds, decompress_feeds),
+        migrations.RemoveField(
+            model_name='icalendarfeed',
+            name='data',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.4 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0016_icalendarfeed_compressed_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='The sha256 of the data', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.4 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0017_icalendarfeed_conditional_get'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='failure_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='next_refresh_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='icalendarpage',
+            name='refresh_interval',
+            field=models.PositiveIntegerField(default=60, help_text='The number of minutes between refreshes of the data from the source by the refresh_calendars command', verbose_name='refresh interval'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.4 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0018_calendar_refresh_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='stale_since',
+            field=models.DateTimeField(blank=True, help_text='When the source first failed since it was last fetched', null=True),
+        ),
+    ]
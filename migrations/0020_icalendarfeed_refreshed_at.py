@@ -0,0 +1,18 @@
+# Generated by Django 6.0.4 on 2026-10-18 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0019_icalendarfeed_stale_since'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
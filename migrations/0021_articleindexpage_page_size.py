@@ -0,0 +1,19 @@
+# Generated by Django 6.0.4 on 2026-10-18 17:50
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0020_icalendarfeed_refreshed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articleindexpage',
+            name='page_size',
+            field=models.PositiveIntegerField(default=20, help_text='The number of articles shown on each page of the index', validators=[django.core.validators.MinValueValidator(1)], verbose_name='articles per page'),
+        ),
+    ]
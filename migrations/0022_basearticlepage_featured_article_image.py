@@ -0,0 +1,30 @@
+# Generated by Django 6.0.4 on 2026-10-18 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def set_featured_article_images(apps, schema_editor):
+    BaseArticlePage = apps.get_model('webikwa257', 'BaseArticlePage')
+    ArticlePageImage = apps.get_model('webikwa257', 'ArticlePageImage')
+    featured_article_images = {}
+    for article_image in ArticlePageImage.objects.order_by('-is_featured', 'sort_order', 'pk').iterator():
+        featured_article_images.setdefault(article_image.page_id, article_image.pk)
+    for page_id, article_image_id in featured_article_images.items():
+        BaseArticlePage.objects.filter(pk=page_id).update(featured_article_image_id=article_image_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0021_articleindexpage_page_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basearticlepage',
+            name='featured_article_image',
+            field=models.ForeignKey(blank=True, editable=False, help_text='The featured image, or the first image if none is featured.  Set when the page is saved', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='webikwa257.articlepageimage'),
+        ),
+        migrations.RunPython(set_featured_article_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 6.0.4 on 2026-10-18 18:40
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+
+def copy_snapshots_to_feeds(apps, schema_editor):
+    IcalendarPage = apps.get_model('webikwa257', 'IcalendarPage')
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for page in IcalendarPage.objects.only('pk', 'event_snapshot').iterator():
+        if page.event_snapshot:
+            IcalendarFeed.objects.filter(icalendar_id=page.pk).update(
+                compressed_snapshot=zlib.compress(json.dumps(page.event_snapshot, separators=(',', ':')).encode('utf-8'))
+            )
+
+
+def copy_feeds_to_snapshots(apps, schema_editor):
+    IcalendarPage = apps.get_model('webikwa257', 'IcalendarPage')
+    IcalendarFeed = apps.get_model('webikwa257', 'IcalendarFeed')
+    for feed in IcalendarFeed.objects.only('pk', 'compressed_snapshot').iterator():
+        if feed.compressed_snapshot:
+            IcalendarPage.objects.filter(pk=feed.icalendar_id).update(
+                event_snapshot=json.loads(zlib.decompress(bytes(feed.compressed_snapshot)))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0022_basearticlepage_featured_article_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icalendarfeed',
+            name='compressed_snapshot',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(copy_snapshots_to_feeds, copy_feeds_to_snapshots),
+        migrations.RemoveField(
+            model_name='icalendarpage',
+            name='event_snapshot',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0.4 on 2026-10-18 18:50
+
+from django.db import migrations, models
+
+
+def delete_duplicate_occurrences(apps, schema_editor):
+    IcalendarOccurrence = apps.get_model('webikwa257', 'IcalendarOccurrence')
+    duplicates = (
+        IcalendarOccurrence.objects.values('icalendar', 'uid', 'start')
+        .annotate(first_pk=models.Min('pk'), rows=models.Count('pk'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        IcalendarOccurrence.objects.filter(
+            icalendar=duplicate['icalendar'], uid=duplicate['uid'], start=duplicate['start']
+        ).exclude(pk=duplicate['first_pk']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webikwa257', '0023_icalendarfeed_compressed_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_occurrences, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='icalendaroccurrence',
+            name='webikwa257__icalend_91e8ef_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='icalendaroccurrence',
+            constraint=models.UniqueConstraint(fields=('icalendar', 'uid', 'start'), name='webikwa257_icalendaroccurrence_unique_start'),
+        ),
+    ]
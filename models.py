@@ -1,10 +1,16 @@
+import contextlib
 import datetime
+import functools
 import html
 import json
 import logging
+import os
+import random
 import re
 import sys
+import tempfile
 import uuid
+import zlib
 import zoneinfo
 
 import icalendar
@@ -14,12 +20,17 @@ import recurring_ical_events
 import requests
 from django import forms
 from django.conf import settings
-from django.db import OperationalError, models
+from django.core.cache import cache
+from django.core.validators import MinValueValidator
+from django.db import OperationalError, models, transaction
+from django.db.models import prefetch_related_objects
 from django.utils import timezone
 from django.utils.html import format_html, mark_safe, strip_tags
+from django.utils.http import urlencode
 from modelcluster.contrib.taggit import ClusterTaggableManager
 from modelcluster.fields import ParentalKey, ParentalManyToManyField
 from taggit.models import TaggedItemBase
+from wagtail.admin.forms import WagtailAdminPageForm
 from wagtail.admin.panels import (
     FieldPanel,
     FieldRowPanel,
@@ -46,30 +57,130 @@ from wagtail.contrib.settings.models import (
 from wagtail.documents import get_document_model
 from wagtail.fields import RichTextField, StreamField
 from wagtail.images.models import Image as WagtailImage
-from wagtail.models import Orderable, Page
+from wagtail.models import Orderable, Page, Site
 from wagtail.search import index
 from wagtail.snippets.models import register_snippet
 from wagtail.snippets.views.snippets import SnippetViewSet
 from wagtailmarkdown.fields import MarkdownField
 
 from .blocks import BodyStreamBlock
+from .feeds import MAX_FEED_SIZE, feed_lock, fetch_feed, fetch_feeds, get_content_hash
+from .calendar_engine import (
+    events,
+    events_page,
+    get_calendars,
+    get_timezone,
+    group_events,
+    uid_events,
+)
+from .ical import (
+    SNAPSHOT_VERSION,
+    DateRange,
+    bucket_events_by_date,
+    build_snapshot,
+    diff_snapshots,
+    get_occurrence_cursor,
+    get_data_uids,
+    get_occurrence_values,
+    parse_occurrence_cursor,
+    snapshot_to_calendar,
+    to_datetime,
+)
 
 logger = logging.getLogger(__name__)
 
 
+SIDEBAR_LOCATION_SETTINGS = {
+    "left": "show_leftbar",
+    "right": "show_rightbar",
+    "top": "show_topbar",
+    "bottom": "show_bottombar",
+}
+
+
+def get_webikwa_setting(key, default=None):
+    try:
+        return settings.WEBIKWA[key]
+    except (AttributeError, KeyError):
+        return default
+
+
+def get_sidebar_cache_key(site_id):
+    return f"webikwa257_sidebars_{ site_id }"
+
+
+def clear_sidebar_cache():
+    site_ids = list(Site.objects.values_list("pk", flat=True)) + [None]
+    cache.delete_many([get_sidebar_cache_key(site_id) for site_id in site_ids])
+
+
+def get_sidebar_tree(site):
+    """
+    Returns the locations and child page ids of the live sidebars for a site, skipping locations turned off in the site template settings
+    The tree is cached until a page is published, unpublished, or moved (see signals.py)
+    """
+    cache_key = get_sidebar_cache_key(site.pk if site else None)
+    sidebar_tree = cache.get(cache_key)
+    if sidebar_tree is not None:
+        return sidebar_tree
+
+    template_settings = SiteTemplateSettings.objects.filter(site=site).first()
+
+    sidebarpages = SidebarPage.objects.live()
+    if site is not None:
+        sidebarpages = sidebarpages.in_site(site)
+
+    sidebar_tree = []
+    for sidebarpage in sidebarpages:
+        setting_name = SIDEBAR_LOCATION_SETTINGS.get(sidebarpage.location)
+        if setting_name:
+            if template_settings:
+                show_location = getattr(template_settings, setting_name)
+            else:
+                show_location = SiteTemplateSettings._meta.get_field(setting_name).default
+            if not show_location:
+                continue
+
+        sidebar_tree.append(
+            {
+                "location": sidebarpage.location,
+                "child_ids": list(sidebarpage.get_children().values_list("pk", flat=True)),
+            }
+        )
+
+    cache.set(
+        cache_key,
+        sidebar_tree,
+        get_webikwa_setting("sidebar_cache_timeout", 60 * 60 * 24),
+    )
+
+    return sidebar_tree
+
+
 def get_sidebars(request):
+    sidebar_tree = get_sidebar_tree(Site.find_for_request(request))
+
+    child_ids = [child_id for sidebar in sidebar_tree for child_id in sidebar["child_ids"]]
+    childpages = {
+        childpage.pk: childpage
+        for childpage in load_article_listing(Page.objects.filter(pk__in=child_ids).specific())
+    }
+
     sidebars = []
-    for sidebarpage in SidebarPage.objects.live().all():
-        sidebar = {"location": sidebarpage.location, "children": []}
-        for childpage in sidebarpage.get_children().specific().iterator():
+    for sidebar_branch in sidebar_tree:
+        sidebar = {"location": sidebar_branch["location"], "children": []}
+        for child_id in sidebar_branch["child_ids"]:
+            childpage = childpages.get(child_id)
+            if childpage is None:
+                continue
             child = {
                 "title": childpage.title,
-                "body_md": childpage.specific.body_md,
-                "body_sf": childpage.specific.body_sf,
-                "context": childpage.specific.get_context(request),
+                "body_md": childpage.body_md,
+                "body_sf": childpage.body_sf,
+                "context": childpage.get_context(request),
             }
             try:
-                child["calendar_format"] = childpage.specific.calendar_format
+                child["calendar_format"] = childpage.calendar_format
 
             except AttributeError:
                 pass
@@ -81,6 +192,93 @@ def get_sidebars(request):
     return sidebars
 
 
+def get_article_cursor(article):
+    return "{},{}".format(
+        article.last_published_at.astimezone(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ"), article.pk
+    )
+
+
+def parse_article_cursor(cursor):
+    """
+    Returns (last published datetime, pk) from a cursor made by get_article_cursor, or None if the cursor is invalid
+    """
+    try:
+        cursor_published, pk = cursor.split(",", 1)
+        return (
+            datetime.datetime.strptime(cursor_published, "%Y%m%dT%H%M%S%fZ").replace(
+                tzinfo=datetime.timezone.utc
+            ),
+            int(pk),
+        )
+    except ValueError:
+        return None
+
+
+def get_keyset_page(queryset, page_size, after=None, before=None, descending=True):
+    """
+    Returns (pages, has_previous, has_next) for a page of page_size pages from the queryset ordered by last_published_at and pk
+    The page follows the cursor after or precedes the cursor before, each a (last published datetime, pk) from parse_article_cursor
+    Only page_size + 1 rows are read, however far into the queryset the page is
+    """
+    forward = before is None
+    cursor = after if forward else before
+    if forward == descending:
+        ordering = ["-last_published_at", "-pk"]
+        lookup = "lt"
+    else:
+        ordering = ["last_published_at", "pk"]
+        lookup = "gt"
+
+    queryset = queryset.filter(last_published_at__isnull=False).order_by(*ordering)
+    if cursor is not None:
+        queryset = queryset.filter(
+            models.Q(**{"last_published_at__" + lookup: cursor[0]})
+            | models.Q(last_published_at=cursor[0], **{"pk__" + lookup: cursor[1]})
+        )
+
+    pages = list(queryset[: page_size + 1])
+    has_more = len(pages) > page_size
+    pages = pages[:page_size]
+    if forward:
+        return pages, after is not None, has_more
+    pages.reverse()
+    return pages, has_more, True
+
+
+def load_article_listing(articles):
+    """
+    Loads the images, authors, and tags shown in listings for a list of pages with a fixed number of queries, instead of
+    a few queries for each article as the template reaches them
+    Each article gets summary_images (the images to display with the summary), and its featured_article_image is set
+    from the loaded images. ArticlePages also get visible_tags (the tags not starting with "_").  Other pages are left as they are
+    Returns the articles as a list
+    """
+    articles = list(articles)
+    base_article_pages = [article for article in articles if isinstance(article, BaseArticlePage)]
+    article_pages = [article for article in base_article_pages if isinstance(article, ArticlePage)]
+
+    prefetch_related_objects(base_article_pages, "article_images__image")
+    prefetch_related_objects(article_pages, "authors__author_image", "tags")
+
+    for article in base_article_pages:
+        article_images = list(article.article_images.all())
+        article.summary_images = [
+            article_image for article_image in article_images if article_image.display_with_summary
+        ]
+        article.featured_article_image = next(
+            (
+                article_image
+                for article_image in article_images
+                if article_image.pk == article.featured_article_image_id
+            ),
+            None,
+        )
+    for article in article_pages:
+        article.visible_tags = [tag for tag in article.tags.all() if not tag.name[0] == "_"]
+
+    return articles
+
+
 class RedirectPage(Page):
 
     target_page = models.ForeignKey(
@@ -123,12 +321,19 @@ class ArticleIndexPage(Page):
     show_pagetitle = models.BooleanField(
         default=True, help_text="If the page title should be shown"
     )
+    page_size = models.PositiveIntegerField(
+        "articles per page",
+        default=20,
+        validators=[MinValueValidator(1)],
+        help_text="The number of articles shown on each page of the index",
+    )
 
     subpage_types = ["ArticlePage"]
 
     content_panels = Page.content_panels + [
         FieldPanel("show_pagetitle"),
         FieldPanel("intro"),
+        FieldPanel("page_size"),
     ]
 
     def get_context(self, request):
@@ -138,11 +343,34 @@ class ArticleIndexPage(Page):
         context = super().get_context(request)
 
         #        ArticlePages = self.get_children().specific().live()
-        ArticlePages = ArticlePage.objects.live().order_by('-last_published_at')
+        ArticlePages = ArticlePage.objects.live()
         if tag:
-            ArticlePages = ArticlePages.filter(tags__name__in=tag).order_by('last_published_at')
+            ArticlePages = ArticlePages.filter(tags__name__in=tag).distinct()
+
+        # newest first, or oldest first when filtered by tag.  ?after= and ?before= page from a cursor
+        ArticlePages, has_previous, has_next = get_keyset_page(
+            ArticlePages,
+            self.page_size,
+            after=parse_article_cursor(request.GET.get("after", "")),
+            before=parse_article_cursor(request.GET.get("before", "")),
+            descending=not tag,
+        )
+
+        context["articlepages"] = load_article_listing(ArticlePages)
 
-        context["articlepages"] = ArticlePages
+        # the urls are for the rel="prev" and rel="next" links of the templates
+        tag_query = [("tag", tag_name) for tag_name in tag]
+        page_url = self.get_url(request)
+        if ArticlePages and has_previous:
+            context["previous_page_query"] = urlencode(
+                tag_query + [("before", get_article_cursor(ArticlePages[0]))]
+            )
+            context["previous_page_url"] = "{}?{}".format(page_url, context["previous_page_query"])
+        if ArticlePages and has_next:
+            context["next_page_query"] = urlencode(
+                tag_query + [("after", get_article_cursor(ArticlePages[-1]))]
+            )
+            context["next_page_url"] = "{}?{}".format(page_url, context["next_page_query"])
 
         context["sidebars"] = get_sidebars(request)
 
@@ -200,8 +428,8 @@ class SidebarPage(Page):
 
     def get_context(self, request):
         context = super().get_context(request)
-        ArticlePages = self.get_children().live()
-        context["articlepages"] = ArticlePages
+        ArticlePages = self.get_children().live().specific()
+        context["articlepages"] = load_article_listing(ArticlePages)
         return context
 
 
@@ -248,11 +476,44 @@ class BaseArticlePage(Page):
         default=True,
         help_text="Show the document link automatically.  One reason to set false would be you're already placing a link in the body",
     )
+    featured_article_image = models.ForeignKey(
+        "webikwa257.ArticlePageImage",
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        help_text="The featured image, or the first image if none is featured.  Set when the page is saved",
+    )
     is_creatable = False
 
     class Meta:
         verbose_name = "Base Article"
 
+    def save(self, *args, **kwargs):
+
+        # pre-save to save the article images with the page
+        super().save(*args, **kwargs)
+
+        # saving a draft revision only updates some fields and leaves the live article images as they are
+        if kwargs.get("update_fields") is None:
+            self.update_featured_image()
+
+    def update_featured_image(self):
+        """
+        Stores the featured article image, or the first article image if none is featured, so that it's read without a query on the images
+        """
+        featured_article_image = (
+            ArticlePageImage.objects.filter(page=self)
+            .order_by("-is_featured", "sort_order", "pk")
+            .first()
+        )
+        if getattr(featured_article_image, "pk", None) != self.featured_article_image_id:
+            BaseArticlePage.objects.filter(pk=self.pk).update(
+                featured_article_image=featured_article_image
+            )
+        self.featured_article_image = featured_article_image
+
     def get_context(self, request):
         context = super().get_context(request)
 
@@ -273,13 +534,7 @@ class BaseArticlePage(Page):
         return context
 
     def featured_image(self):
-        try:
-            return self.article_images.filter(is_featured=True).first()
-        except ArticlePageImage.DoesNotExist:
-            try:
-                return self.article_images.first()
-            except ArticlePageImage.DoesNotExist:
-                return None
+        return self.featured_article_image
 
     def get_default_order(self):
         """ "
@@ -289,6 +544,41 @@ class BaseArticlePage(Page):
         return "-latest_revision_created_at"
 
 
+@functools.lru_cache(maxsize=256)
+def get_static_tag_groups(included_tag_names_string, tag_titles_string, group_titles_string):
+    """
+    Returns the tag groups configured for an ArticleStaticTagsIndexPage as a tuple of (group title, ((tag name, tag title), ...))
+    The result is cached by the configuration strings, so each revision of a page is only parsed once
+    """
+    tag_titles = (
+        re.split(r";|,", tag_titles_string) if tag_titles_string > "" else []
+    )
+    group_titles = (
+        re.split(r";|,", group_titles_string) if group_titles_string > "" else []
+    )
+
+    tag_groups = []
+    t = 0
+    for g, included_tag_names in enumerate(included_tag_names_string.split(";")):
+        tag_sets = []
+        for included_tag_name in included_tag_names.split(","):
+            included_tag_name = included_tag_name.strip()
+            # tag titles are counted across groups, including for tags that are empty
+            if included_tag_name:
+                tag_title = (
+                    tag_titles[t].strip()
+                    if len(tag_titles) > t
+                    else (included_tag_name if not included_tag_name[0] == "_" else " ")
+                )
+                tag_sets.append((included_tag_name, tag_title))
+            t = t + 1
+
+        group_title = group_titles[g] if len(group_titles) > g else ""
+        tag_groups.append((group_title, tuple(tag_sets)))
+
+    return tuple(tag_groups)
+
+
 class ArticleStaticTagsIndexPage(Page):
 
     show_pagetitle = models.BooleanField(
@@ -372,58 +662,49 @@ class ArticleStaticTagsIndexPage(Page):
 
         context["full_body_groups"] = full_body_groups
 
-        article_page_groups = []
-
-        included_tag_name_groups = self.included_tag_names_string.split(";")
-        tag_titles = (
-            re.split(r";|,", self.tag_titles_string)
-            if self.tag_titles_string > ""
-            else []
-        )
-        group_titles = (
-            re.split(r";|,", self.group_titles_string)
-            if self.group_titles_string > ""
-            else []
+        tag_groups = get_static_tag_groups(
+            self.included_tag_names_string,
+            self.tag_titles_string,
+            self.group_titles_string,
         )
 
-        t = 0
-        for g in range(len(included_tag_name_groups)):
-            new_article_page_group = {"article_page_sets": []}
-            if len(group_titles) > g:
-                if group_titles[g] > "":
-                    new_article_page_group["group_title"] = group_titles[g]
-            article_page_sets = []
-            included_tag_names = included_tag_name_groups[g].split(",")
-
-            for i in range(len(included_tag_names)):
-                included_tag_name = included_tag_names[i].strip()
-                new_article_page_set = {}
-
-                new_article_page_set["article_pages"] = (
-                    ArticlePage.objects.live()
-                    .filter(tags__name=included_tag_name)
-                    .order_by("-last_published_at")
-                )
-
-                if new_article_page_set["article_pages"]:
-                    new_article_page_set["tagname"] = included_tag_name
-                    tag_title = (
-                        tag_titles[t].strip()
-                        if len(tag_titles) > t
-                        else (
-                            included_tag_name
-                            if not included_tag_name[0] == "_"
-                            else " "
-                        )
-                    )
-                    new_article_page_set["title"] = tag_title
-                    article_page_sets.append(new_article_page_set)
-
-                t = t + 1
+        # the live ArticlePages for every tag are read in one query through the tag table, newest first
+        article_pages_by_tag = {}
+        article_pages = {}
+        tagged_items = (
+            ArticlePageTag.objects.filter(
+                tag__name__in=[
+                    tag_name
+                    for group_title, tag_sets in tag_groups
+                    for tag_name, tag_title in tag_sets
+                ],
+                content_object__live=True,
+            )
+            .select_related("tag", "content_object")
+            .order_by("-content_object__last_published_at", "content_object_id")
+        )
+        for tagged_item in tagged_items:
+            article_page = article_pages.setdefault(
+                tagged_item.content_object_id, tagged_item.content_object
+            )
+            article_pages_by_tag.setdefault(tagged_item.tag.name, []).append(article_page)
+        load_article_listing(article_pages.values())
 
+        article_page_groups = []
+        for group_title, tag_sets in tag_groups:
+            article_page_sets = [
+                {
+                    "article_pages": article_pages_by_tag[tag_name],
+                    "tagname": tag_name,
+                    "title": tag_title,
+                }
+                for tag_name, tag_title in tag_sets
+                if tag_name in article_pages_by_tag
+            ]
             if article_page_sets:
-                new_article_page_group["article_page_sets"] = article_page_sets
-
+                new_article_page_group = {"article_page_sets": article_page_sets}
+                if group_title:
+                    new_article_page_group["group_title"] = group_title
                 article_page_groups.append(new_article_page_group)
 
         context["article_page_groups"] = article_page_groups
@@ -557,7 +838,18 @@ class ArticlePlacementPage(Page):
             zones.append( {} )
             zones[z]['title'] = zone_titles[z] if z in zone_titles else ""
             zones[z]['class'] = f"zone_{ z }"
-            zones[z]['placements'] = [ placement for placement in self.article_placements.filter(article__live=True).filter(zone=z).exclude(expiration_date__lt=datetime.date.today()).order_by("-article__last_published_at")]
+            zones[z]['placements'] = []
+
+        # all of the placements are read in one query and bucketed by zone.  Zones past the last zone are folded into it
+        placements = list(
+            self.article_placements.filter(article__live=True)
+            .exclude(expiration_date__lt=datetime.date.today())
+            .select_related("article")
+            .order_by("-article__last_published_at", "pk")
+        )
+        load_article_listing(placement.article for placement in placements)
+        for placement in placements if zones else []:
+            zones[min(max(placement.zone, 0), self.zone_qty)]['placements'].append(placement)
 
         context['zones'] = zones
 
@@ -768,6 +1060,32 @@ class ArticlePlacementViewSet(SnippetViewSet):
 
 register_snippet(ArticlePlacementViewSet)
 
+def parse_start_span_count(ical_start_span_count):
+    """
+    Returns (start, span, count) from the "start,span,count" of an IcalCombinerPage, with 0, 3660, and None for missing numbers
+    """
+    start_input, span_input, count_input = [0, 3660, None]
+    ical_inputs = [
+        int(num) if num.strip().lstrip('-').isnumeric() else None
+        for num in ical_start_span_count.split(",")
+    ]
+
+    try:
+        start_input = int(ical_inputs[0])
+    except (TypeError, IndexError):
+        pass
+    try:
+        span_input = int(ical_inputs[1])
+    except (TypeError, IndexError):
+        pass
+    try:
+        count_input = int(ical_inputs[2])
+    except (TypeError, IndexError):
+        pass
+
+    return start_input, span_input, count_input
+
+
 class IcalCombinerPage(BaseArticlePage):
 
     CALENDAR_FORMAT_CHOICES = [
@@ -820,6 +1138,29 @@ class IcalCombinerPage(BaseArticlePage):
         )
     ]
 
+    def get_calendar_month_context(self, request, calendar_dates):
+        """
+        Returns the month of calendar_dates to be shown in the grid, chosen with ?month=YYYY-MM, along with the neighboring months for paging
+        """
+        months = calendar_dates.months()
+        if not months:
+            return {}
+        month = months[0]
+        try:
+            year_input, month_input = request.GET.get("month", "").split("-")
+            if (int(year_input), int(month_input)) in months:
+                month = (int(year_input), int(month_input))
+        except ValueError:
+            pass
+
+        m = months.index(month)
+        return {
+            "calendar_month": datetime.date(month[0], month[1], 1),
+            "calendar_month_dates": calendar_dates.for_month(*month),
+            "calendar_month_previous": "{}-{:02}".format(*months[m - 1]) if m > 0 else "",
+            "calendar_month_next": "{}-{:02}".format(*months[m + 1]) if m < len(months) - 1 else "",
+        }
+
     def get_context(self, request):
 
         context = super().get_context(request)
@@ -827,119 +1168,44 @@ class IcalCombinerPage(BaseArticlePage):
 
         if self.calendars:
 
-            start_input, span_input, count_input = [0, 3660, None]
-            ical_inputs = [
-                int(num) if num.strip().lstrip('-').isnumeric() else None
-                for num in self.ical_start_span_count.split(",")
-            ]
-            cd_events = []
-            cd_events_grouped = {}
+            start_input, span_input, count_input = parse_start_span_count(self.ical_start_span_count)
             calendar_refs = []
 
-            try:
-                start_input = int(ical_inputs[0])
-            except (TypeError, IndexError):
-                pass
-            try:
-                span_input = int(ical_inputs[1])
-            except (TypeError, IndexError):
-                pass
-            try:
-                count_input = int(ical_inputs[2])
-            except (TypeError, IndexError):
-                pass
-
-            start_date = datetime.datetime.now() + datetime.timedelta(days=start_input)
+            start_date = timezone.localtime() + datetime.timedelta(days=start_input)
 
-            if span_input is None:
-                span_input = 3660
             end_date = start_date + datetime.timedelta(span_input)
 
-            for ical in self.calendars.all():
-                ical_string = ical.data
-                uidlinks = {}
-                calendar_refs.append({"slug": ical.slug, "title": ical.title})
-
-                for link in ical.uid_links.all():
-                    uidlinks[link.uid] = link.url
-
-                for ical_event in ical.ical_events.all():
-                    uidlinks[ical_event.uid] = ical_event.url
-
-                uidblocks = []
-                for block in ical.uid_blocks.all():
-                    if block.uid > "":
-                        uidblocks.append(block.uid)
+            context["calendar_dates"] = DateRange(start_date, span_input + 1)
+
+            events_start, events_end, events_count = start_date, end_date, count_input
+            month_dates = None
+            if self.calendar_format == "GRID":
+                context.update(self.get_calendar_month_context(request, context["calendar_dates"]))
+                month_dates = context.get("calendar_month_dates")
+                if month_dates:
+                    # the grid shows every event in the visible month
+                    events_start = max(start_date, month_dates[0].replace(hour=0, minute=0, second=0, microsecond=0))
+                    events_end = min(
+                        end_date,
+                        month_dates[-1].replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1),
+                    )
+                    events_count = None
 
-                try:
-                    ical_calendar = icalendar.Calendar.from_ical(ical_string)
-                except ValueError:
-                    print("ICAL Parse Error")
-                    continue
+            calendars = get_calendars(self.calendars.all())
+            stale_since = get_stale_since(calendars)
+            for ical in calendars:
+                calendar_refs.append(
+                    {"slug": ical.slug, "title": ical.title, "stale_since": stale_since.get(ical.pk)}
+                )
 
-                ical_events = recurring_ical_events.of(ical_calendar).between(
-                    start_date, end_date
+            context["events"] = events(calendars, (events_start, events_end), events_count)
+            if events_count is None or len(context["events"]) < events_count:
+                # every event in the window was read
+                context["events_grouped"] = group_events(context["events"])
+            else:
+                context["events_grouped"] = events(
+                    calendars, (events_start, events_end), events_count, group_by_uid=True
                 )
-                for ical_event in ical_events:
-                    if ical_event["UID"] not in uidblocks:
-                        cd_event = {}
-                        uid = ical_event["UID"]
-                        cd_event["uid"] = uid
-                        cd_event["calendar_slug"] = ical.slug
-                        cd_event["calendar"] = ical.get_url()
-                        cd_event["start"] = ical_event["DTSTART"].dt
-                        cd_event["start_type"] = type(cd_event["start"]).__name__
-                        cd_event["start_d"] = (
-                            cd_event["start"].date()
-                            if cd_event["start_type"] == "datetime"
-                            else cd_event["start"]
-                        )
-                        cd_event["start_dt"] = (
-                            cd_event["start"]
-                            if cd_event["start_type"] == "datetime"
-                            else datetime.datetime(
-                                cd_event["start"].year,
-                                cd_event["start"].month,
-                                cd_event["start"].day,
-                                tzinfo=zoneinfo.ZoneInfo(settings.TIME_ZONE),
-                            )
-                        )
-                        cd_event["end"] = ical_event["DTEND"].dt
-
-                        try:
-                            cd_event["summary"] = ical_event["SUMMARY"]
-                        except KeyError:
-                            cd_event["summary"] = ""
-                        try:
-                            cd_event["description"] = ical_event["DESCRIPTION"]
-                        except KeyError:
-                            cd_event["description"] = ""
-
-                        if ical_event["UID"] in uidlinks:
-                            cd_event["link"] = uidlinks[ical_event["UID"]]
-
-                        cd_events.append(cd_event)
-                        if uid not in cd_events_grouped:
-                            cd_events_grouped[uid] = cd_event
-                            cd_events_grouped[uid]["starts"] = [cd_event["start"]]
-                        else:
-                            cd_events_grouped[uid]["starts"].append(cd_event["start"])
-                            if cd_event["start"] < cd_events_grouped[uid]["start"]:
-                                cd_events_grouped[uid]["start"] = cd_event["start"]
-
-            context["events"] = sorted(cd_events, key=lambda event: event["start_dt"])
-            if count_input is not None:
-                context["events"] = context["events"][:count_input]
-
-            cd_events_grouped_list = []
-            for uid in cd_events_grouped:
-                cd_events_grouped[uid]["starts"].sort()
-                cd_events_grouped_list.append(cd_events_grouped[uid])
-            context["events_grouped"] = sorted(
-                cd_events_grouped_list, key=lambda event: event["start_d"]
-            )
-            if count_input is not None:
-                context["events_grouped"] = context["events_grouped"][:count_input]
 
             context["datetime_formats"] = {"date": "D Y M d", "time": "g:iA"}
             if self.calendar_dt_format:
@@ -955,11 +1221,10 @@ class IcalCombinerPage(BaseArticlePage):
 
             context['show_hide_calendars'] = self.show_hide_calendars
 
-            caldate = start_date
-            context["calendar_dates"] = [caldate]
-            for i in range(span_input):
-                caldate = caldate + datetime.timedelta(days=1)
-                context["calendar_dates"].append(caldate)
+            if month_dates:
+                context["calendar_days"] = bucket_events_by_date(
+                    context["events"], month_dates, zoneinfo.ZoneInfo(get_timezone())
+                )
 
         return context
 
@@ -1358,11 +1623,6 @@ class ArticleCommentPage(Page):
     ]
 
 
-def get_timezone():
-
-    return settings.TIME_ZONE if hasattr(settings, "TIME_ZONE") else "Etc/UTC"
-
-
 def get_empty_ical():
     empty_ical = f"""BEGIN:VCALENDAR
 VERSION:2.0
@@ -1375,6 +1635,43 @@ END:VCALENDAR
     return empty_ical
 
 
+def normalize_ical_text(value):
+    """
+    Returns ics text with the line endings and surrounding whitespace that browsers and form fields change made uniform
+    """
+    return value.replace("\r\n", "\n").strip()
+
+
+class IcalendarPageForm(WagtailAdminPageForm):
+    """
+    Edits the ics data, which is kept in the IcalendarFeed of the page instead of a field of the page
+    The data is read only for calendars with a source, whose data is refreshed from the source.  Otherwise it's only
+    written if it was edited, so that resubmitting the form doesn't rewrite the feed and rebuild the occurrences
+    """
+
+    data = forms.CharField(
+        label="body",
+        required=False,
+        widget=forms.Textarea,
+        help_text="The ics data. If source is filled in, this is read only and refreshed from the source. If you wish to edit this field, ensure the source field is blank",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["data"].initial = self.instance.data
+        if self.instance.source:
+            self.fields["data"].disabled = True
+
+    def save(self, commit=True):
+        if (
+            "data" in self.changed_data
+            and not self.cleaned_data.get("source")
+            and normalize_ical_text(self.cleaned_data["data"]) != normalize_ical_text(self.instance.data)
+        ):
+            self.instance.data = self.cleaned_data["data"]
+        return super().save(commit=commit)
+
+
 class IcalendarPage(Page):
     """
     For retrieving events from a remote ical.
@@ -1384,11 +1681,10 @@ class IcalendarPage(Page):
     source = models.URLField(
         "source", blank=True, help_text="The ics source which will copied to the data"
     )
-    data = models.TextField(
-        "body",
-        blank=True,
-        default=get_empty_ical,
-        help_text="The ics data. If source is filled in, this will be overwritten. If you wish to edit this field, ensure the source field is blank",
+    refresh_interval = models.PositiveIntegerField(
+        "refresh interval",
+        default=60,
+        help_text="The number of minutes between refreshes of the data from the source by the refresh_calendars command",
     )
     is_safe = models.BooleanField(
         "is safe",
@@ -1400,10 +1696,23 @@ class IcalendarPage(Page):
         default=True,
         help_text="Upon save, automaticall delete links and blocks for events that are no longer on this calendar",
     )
+    occurrences_start = models.DateTimeField(
+        "occurrences start", blank=True, null=True, editable=False
+    )
+    occurrences_end = models.DateTimeField(
+        "occurrences end", blank=True, null=True, editable=False
+    )
     parent_page_types = ["IcalendarIndexPage"]
 
+    base_form_class = IcalendarPageForm
+
+    _data = None
+    _event_snapshot = None
+    _feed = None
+
     content_panels = Page.content_panels + [
         FieldPanel("source"),
+        FieldPanel("refresh_interval"),
         FieldPanel("data"),
         InlinePanel("ical_events"),
         InlinePanel("uid_links"),
@@ -1414,122 +1723,458 @@ class IcalendarPage(Page):
 
     def save(self, *args, **kwargs):
 
-        # pre-save to get a PK if new, and update children
-        super().save(*args, **kwargs)
+        # saving a draft revision only updates some fields.  Its data is kept with the revision until it's published
+        if kwargs.get("update_fields") is not None:
+            super().save(*args, **kwargs)
+            return
+
+        # saving the page row locks it until the end of the transaction, so the feed and occurrences are written by one
+        # writer at a time (see lock_for_update).  What another writer stored since the page was loaded is reloaded,
+        # keeping the edited data
+        with transaction.atomic():
+            # pre-save to get a PK if new, and update children
+            super().save(*args, **kwargs)
+
+            data = self._data
+            self.reload_feed()
+            self._data = data
+
+            # the source is fetched by refresh_calendars, not while the editor waits
+            if self.source:
+                self.get_feed().next_refresh_at = timezone.now()
+
+            self.update_data()
+
+    def serializable_data(self):
+        data = super().serializable_data()
+        # the horizon belongs to the stored occurrences, not to a revision
+        for field_name in ["occurrences_start", "occurrences_end"]:
+            data.pop(field_name, None)
+        # ics data edited in a draft is kept with the revision, and written to the feed when the revision is published
+        if self._data is not None and get_content_hash(self._data) != self.get_feed().content_hash:
+            data["data"] = self._data
+        return data
+
+    def with_content_json(self, content):
+        page = super().with_content_json(content)
+        page.occurrences_start = self.occurrences_start
+        page.occurrences_end = self.occurrences_end
+        if "data" in content:
+            page.data = content["data"]
+        return page
+
+    def copy_all_child_relations(self, target, exclude=None):
+        # copies, aliases and translations of the page are made with this, and the data is kept in the feed rather than
+        # in a field, so it's given to the target here.  Saving the target builds its feed, snapshot, and occurrences
+        child_object_map = super().copy_all_child_relations(target, exclude=exclude)
+        target.data = self.data
+        return child_object_map
+
+    def refresh(self, fetched=None):
+        """
+        Fetches the source and updates the data, event snapshot, and occurrences, without saving the rest of the page
+        If the source was already fetched, fetched is the FeedResponse or the exception raised by fetching it, and the
+        caller holds the refresh lock.  Otherwise the refresh lock is held while fetching, and if another process refreshed
+        the page while this one waited for the lock, the page isn't refreshed again.  The results are written under
+        lock_for_update, after the refresh lock is taken
+        The next refresh is scheduled after refresh_interval minutes, or after a growing backoff if the fetch fails
+        Both are lengthened by up to calendar_refresh_jitter (a fraction, 0.1 by default) of themselves so that calendars
+        saved together aren't refreshed together.  The backoff is limited by calendar_refresh_max_backoff minutes (one day by default)
+        If the fetch fails, the last good data is kept and the feed is marked stale.  After calendar_refresh_failure_threshold
+        failures in a row (5 by default), the source isn't fetched at all until the backoff has passed
+        """
+        if fetched is None:
+            requested_at = timezone.now()
+            with self.refresh_lock():
+                self.reload_feed()
+                feed = self.get_feed()
+                if feed.refreshed_at is not None and feed.refreshed_at >= requested_at:
+                    logger.info("Calendar %s was refreshed by another process", self.slug)
+                    return
+                if feed.is_circuit_open():
+                    logger.info("Calendar source for %s is not fetched until %s", self.slug, feed.next_refresh_at)
+                    return
+                try:
+                    fetched = fetch_feed(self.source, feed.etag, feed.last_modified, **get_fetch_options())
+                except requests.RequestException as e:
+                    fetched = e
+                self.refresh(fetched)
+            return
+
+        # the page row is locked before the feed and occurrences are written, as it is by saving the page, and the
+        # feed is reloaded in case another writer stored it after it was read for the fetch
+        with transaction.atomic():
+            self.lock_for_update()
+            self.reload_feed()
+            feed = self.get_feed()
+            interval = datetime.timedelta(minutes=self.refresh_interval)
+            feed.refreshed_at = timezone.now()
+            if isinstance(fetched, Exception):
+                feed.failure_count = feed.failure_count + 1
+                if feed.stale_since is None:
+                    feed.stale_since = timezone.now()
+                interval = min(
+                    interval * 2 ** feed.failure_count,
+                    datetime.timedelta(minutes=get_webikwa_setting("calendar_refresh_max_backoff", 60 * 24)),
+                )
+                logger.warning("Calendar source for %s failed %s times: %s", self.slug, feed.failure_count, fetched)
+            else:
+                feed.etag = fetched.etag
+                feed.last_modified = fetched.last_modified
+                feed.failure_count = 0
+                feed.stale_since = None
+                if fetched.text is not None:
+                    self.data = fetched.text
+
+            feed.next_refresh_at = timezone.now() + interval * (
+                1 + random.uniform(0, get_webikwa_setting("calendar_refresh_jitter", 0.1))
+            )
+
+            self.update_data()
 
-        # create the ics calendar
-        if self.source:
-            calendar_response = requests.get(self.source)
-            self.data = calendar_response.text
+    def update_data(self):
+        """
+        Adds the local events to the data, deletes stale links and blocks, and saves the feed
+        Then rebuilds the event snapshot and updates the occurrences if the data isn't the data of the event snapshot, or
+        rolls the occurrence horizon forward if it's stale, and saves them
+        Returns whether the event snapshot or the occurrence horizon changed
+        """
+        feed = self.get_feed()
 
-        # add ical_event objects to the ics data
+        # add the ical_event objects which aren't in the ics data yet, all at once
+        uids = get_data_uids(self.data)
+        vevents = []
         for ical_event in self.ical_events.all():
-            if ical_event.uid not in self.data:
-                data = self.data
-                insert_point = data.find("END:VCALENDAR")
-                self.data = (
-                    data[:insert_point] + ical_event.get_vevent() + data[insert_point:]
-                )
+            if ical_event.uid not in uids:
+                vevents.append(ical_event.get_vevent())
+                uids.add(ical_event.uid)
+        if vevents:
+            data = self.data
+            insert_point = data.rfind("END:VCALENDAR")
+            self.data = data[:insert_point] + "".join(vevents) + data[insert_point:]
 
         if self.delete_stale_links_blocks:
-            for uid_link in self.uid_links.all():
-                if uid_link.uid not in self.data:
-                    uid_link.delete()
-            for uid_block in self.uid_blocks.all():
-                if uid_block.uid not in self.data:
-                    uid_block.delete()
+            IcalendarLinkPage.objects.filter(
+                pk__in=[uid_link.pk for uid_link in self.uid_links.all() if uid_link.uid not in uids]
+            ).delete()
+            IcalendarBlockPage.objects.filter(
+                pk__in=[uid_block.pk for uid_block in self.uid_blocks.all() if uid_block.uid not in uids]
+            ).delete()
+
+        # the data is only rewritten if it changed, and only parsed if it isn't the data of the event snapshot
+        content_hash = get_content_hash(self.data)
+        if content_hash != feed.content_hash:
+            feed.data = self.data
+            feed.content_hash = content_hash
+            feed.save()
+        else:
+            feed.save(update_fields=IcalendarFeed.STATE_FIELDS)
+
+        if (
+            content_hash == self.event_snapshot.get("content_hash")
+            and self.occurrences_start is not None
+        ):
+            if not self.is_horizon_stale():
+                logger.info("Calendar data for %s is unchanged", self.slug)
+                return False
+            # roll the horizon forward, expanding only the part which wasn't stored yet
+            self.update_occurrences(self.get_event_snapshot())
+        else:
+            previous_snapshot = self.event_snapshot
+            self.rebuild_event_snapshot()
+            self.update_occurrences(previous_snapshot)
 
-        super().save(*args, **kwargs)
+        self.save_event_snapshot()
+        return True
 
-    def get_context(self, request):
+    def save_event_snapshot(self):
+        """
+        Saves the event snapshot to the feed and the occurrence horizon to the page, without saving the rest of either
+        """
+        feed = self.get_feed()
+        feed.event_snapshot = self.event_snapshot
+        feed.save(update_fields=None if feed._state.adding else ["compressed_snapshot"])
+        IcalendarPage.objects.filter(pk=self.pk).update(
+            occurrences_start=self.occurrences_start,
+            occurrences_end=self.occurrences_end,
+        )
 
-        context = super().get_context(request)
+    def lock_for_update(self):
+        """
+        Locks the page row until the end of the transaction
+        Every writer of the feed and occurrences locks the page row before writing them, as saving the page does, so
+        writers wait for each other in the database and always take their locks in the same order.  The refresh lock
+        only keeps a source from being fetched twice at once, and is never taken by a writer which holds the page row
+        """
+        list(IcalendarPage.objects.select_for_update().filter(pk=self.pk).values_list("pk", flat=True))
+
+    def refresh_lock(self, blocking=True):
+        """
+        Returns a context manager holding the lock on fetching the source of the page, shared by every process on the host
+        The lock files are kept in calendar_lock_dir, which can be set in settings.WEBIKWA.  The default is in the
+        temporary directory, which isn't shared by processes with a private /tmp (such as systemd services with
+        PrivateTmp, or separate containers).  Processes which refresh calendars should be given a shared calendar_lock_dir,
+        or a source may be fetched by more than one of them at once.  Writes are still serialized by lock_for_update
+        """
+        return feed_lock(
+            get_webikwa_setting("calendar_lock_dir", os.path.join(tempfile.gettempdir(), "webikwa257")),
+            "icalendar-{}".format(self.pk),
+            blocking,
+        )
 
-        cd_events = []
-        cd_events_grouped = {}
-        calendar_refs = []
+    def reload_feed(self):
+        """
+        Reloads the feed, along with the event snapshot and occurrence horizon, which another process may have refreshed
+        """
+        self._feed = None
+        self._data = None
+        self._event_snapshot = None
+        self.refresh_from_db(fields=["occurrences_start", "occurrences_end"])
 
-        ical_string = self.data
-        uidlinks = {}
-        calendar_refs.append({"slug": self.slug, "title": self.title})
+    def get_feed(self):
+        """
+        Returns the IcalendarFeed of the page, or a new one if the page doesn't have one yet
+        """
+        if self._feed is None:
+            self._feed = (
+                IcalendarFeed.objects.filter(icalendar_id=self.pk).first() if self.pk else None
+            ) or IcalendarFeed(icalendar=self)
+        return self._feed
+
+    @property
+    def data(self):
+        """
+        The ics data, which is read from the IcalendarFeed of the page when it's first used
+        """
+        if self._data is None:
+            self._data = self.get_feed().data
+        return self._data
 
-        for link in self.uid_links.all():
-            uidlinks[link.uid] = link.url
+    @data.setter
+    def data(self, value):
+        self._data = value
 
-        for ical_event in self.ical_events.all():
-            uidlinks[ical_event.uid] = ical_event.url
+    @property
+    def event_snapshot(self):
+        """
+        The events parsed from the data, kept with the data in the IcalendarFeed of the page so that the data doesn't need
+        to be parsed for each request, and the page row stays small.  It's read when it's first used
+        """
+        if self._event_snapshot is None:
+            self._event_snapshot = self.get_feed().event_snapshot
+        return self._event_snapshot
 
-        uidblocks = []
-        for block in self.uid_blocks.all():
-            if block.uid > "":
-                uidblocks.append(block.uid)
+    @event_snapshot.setter
+    def event_snapshot(self, value):
+        self._event_snapshot = value
 
+    def parse_data(self):
         try:
-            ical_calendar = icalendar.Calendar.from_ical(ical_string)
+            return icalendar.Calendar.from_ical(self.data)
         except ValueError:
-            print("ICAL Parse Error")
-
-        ical_events = recurring_ical_events.of(ical_calendar).all()
-        for ical_event in ical_events:
-            if ical_event["UID"] not in uidblocks:
-                cd_event = {}
-                uid = ical_event["UID"]
-                cd_event["uid"] = uid
-                cd_event["calendar_slug"] = self.slug
-                cd_event["calendar"] = self.get_url()
-                cd_event["start"] = ical_event["DTSTART"].dt
-                cd_event["start_type"] = type(cd_event["start"]).__name__
-                cd_event["start_d"] = (
-                    cd_event["start"].date()
-                    if cd_event["start_type"] == "datetime"
-                    else cd_event["start"]
-                )
-                cd_event["start_dt"] = (
-                    cd_event["start"]
-                    if cd_event["start_type"] == "datetime"
-                    else datetime.datetime(
-                        cd_event["start"].year,
-                        cd_event["start"].month,
-                        cd_event["start"].day,
-                        tzinfo=zoneinfo.ZoneInfo(settings.TIME_ZONE),
-                    )
+            logger.warning("ICAL Parse Error for %s", self.slug)
+            return None
+
+    def rebuild_event_snapshot(self):
+        ical_calendar = self.parse_data()
+        if ical_calendar is None:
+            event_snapshot = {"version": SNAPSHOT_VERSION, "events": {}}
+        else:
+            event_snapshot = build_snapshot(ical_calendar)
+        event_snapshot["content_hash"] = get_content_hash(self.data)
+        self.event_snapshot = event_snapshot
+
+    def get_event_snapshot(self):
+        """
+        Returns the stored event snapshot, rebuilding it from the data if it was made with an older snapshot version
+        """
+        if self.event_snapshot.get("version") != SNAPSHOT_VERSION:
+            self.rebuild_event_snapshot()
+            if self.pk:
+                feed = self.get_feed()
+                feed.event_snapshot = self.event_snapshot
+                feed.save(update_fields=None if feed._state.adding else ["compressed_snapshot"])
+        return self.event_snapshot
+
+    def get_snapshot_calendar(self):
+        return snapshot_to_calendar(self.get_event_snapshot())
+
+    def get_occurrence_days(self):
+        """
+        Returns the number of days before and after now which the stored occurrences need to cover
+        These are occurrence_past_days and occurrence_future_days, which can be set in settings.WEBIKWA, widened to cover
+        the start and span of every live combiner which includes the calendar, so that combiners read stored occurrences
+        instead of expanding the event snapshot
+        """
+        past_days = get_webikwa_setting("occurrence_past_days", 31)
+        future_days = get_webikwa_setting("occurrence_future_days", 366)
+        if self.pk:
+            for ical_start_span_count in IcalCombinerPage.objects.live().filter(calendars=self).values_list(
+                "ical_start_span_count", flat=True
+            ):
+                start_input, span_input, count_input = parse_start_span_count(ical_start_span_count)
+                past_days = max(past_days, 1 - start_input)
+                future_days = max(future_days, start_input + span_input + 1)
+        return past_days, future_days
+
+    def get_occurrence_horizon(self):
+        """
+        Returns the (start, end) of the occurrences to store
+        The end is occurrence_roll_days (1 by default) past the days to cover, so that the horizon only needs to be rolled
+        forward once in that many days
+        """
+        past_days, future_days = self.get_occurrence_days()
+        now = timezone.now()
+        return (
+            now - datetime.timedelta(days=past_days),
+            now + datetime.timedelta(days=future_days + get_webikwa_setting("occurrence_roll_days", 1)),
+        )
+
+    def is_horizon_stale(self):
+        """
+        Returns whether the stored occurrences no longer cover the days they need to
+        """
+        if self.occurrences_start is None:
+            return True
+        past_days, future_days = self.get_occurrence_days()
+        now = timezone.now()
+        return (
+            self.occurrences_start > now - datetime.timedelta(days=past_days)
+            or self.occurrences_end < now + datetime.timedelta(days=future_days)
+        )
+
+    def expand_occurrences(self, start, end, uids=None, tz=None):
+        tz = tz or zoneinfo.ZoneInfo(get_timezone())
+        ical_calendar = snapshot_to_calendar(self.get_event_snapshot(), uids)
+        occurrences = {}
+        for ical_event in recurring_ical_events.of(ical_calendar).between(start, end):
+            occurrence = IcalendarOccurrence.from_values(self, get_occurrence_values(ical_event), tz)
+            # a feed can repeat an event, but each event is stored once for each start
+            occurrences.setdefault((occurrence.uid, occurrence.start), occurrence)
+        return list(occurrences.values())
+
+    def rebuild_occurrences(self):
+        """
+        Replaces the stored occurrences with the occurrences from the event snapshot within the rolling horizon
+        The horizon can be set in settings.WEBIKWA with occurrence_past_days and occurrence_future_days
+        """
+        horizon_start, horizon_end = self.get_occurrence_horizon()
+
+        occurrences = self.expand_occurrences(horizon_start, horizon_end)
+
+        with transaction.atomic():
+            self.occurrences.all().delete()
+            IcalendarOccurrence.objects.bulk_create(occurrences, batch_size=500)
+
+        self.occurrences_start = horizon_start
+        self.occurrences_end = horizon_end
+
+    def update_occurrences(self, previous_snapshot):
+        """
+        Updates the stored occurrences after the event snapshot changed from previous_snapshot
+        Only the events which were added, changed, or removed are expanded and written, along with any occurrences
+        of the other events in the part of the horizon which wasn't already stored
+        Occurrences outside the horizon are deleted, so that a horizon which shrank can be extended again later
+        """
+        horizon_start, horizon_end = self.get_occurrence_horizon()
+        if (
+            previous_snapshot.get("version") != SNAPSHOT_VERSION
+            or self.occurrences_start is None
+            or horizon_start < self.occurrences_start
+            or horizon_start >= self.occurrences_end
+        ):
+            self.rebuild_occurrences()
+            return
+
+        changed_uids, removed_uids = diff_snapshots(previous_snapshot, self.event_snapshot)
+        tz = zoneinfo.ZoneInfo(get_timezone())
+
+        occurrences = self.expand_occurrences(horizon_start, horizon_end, changed_uids, tz)
+        if horizon_end > self.occurrences_end:
+            unchanged_uids = set(self.event_snapshot["events"]) - changed_uids
+            occurrences.extend(
+                occurrence
+                for occurrence in self.expand_occurrences(
+                    self.occurrences_end, horizon_end, unchanged_uids, tz
                 )
-                cd_event["end"] = ical_event["DTEND"].dt
+                if occurrence.start >= self.occurrences_end
+            )
 
-                try:
-                    cd_event["summary"] = ical_event["SUMMARY"]
-                except KeyError:
-                    cd_event["summary"] = ""
-                try:
-                    cd_event["description"] = ical_event["DESCRIPTION"]
-                except KeyError:
-                    cd_event["description"] = ""
-
-                if ical_event["UID"] in uidlinks:
-                    cd_event["link"] = uidlinks[ical_event["UID"]]
-
-                cd_events.append(cd_event)
-                if uid not in cd_events_grouped:
-                    cd_events_grouped[uid] = cd_event
-                    cd_events_grouped[uid]["starts"] = [cd_event["start"]]
-                else:
-                    cd_events_grouped[uid]["starts"].append(cd_event["start"])
-                    if cd_event["start"] < cd_events_grouped[uid]["start"]:
-                        cd_events_grouped[uid]["start"] = cd_event["start"]
-
-                if ical_event["UID"] == request.GET.get("uid", ""):
-                    context["event"] = cd_event
-
-        context["events"] = sorted(cd_events, key=lambda event: event["start_dt"])
-
-        cd_events_grouped_list = []
-        for uid in cd_events_grouped:
-            cd_events_grouped[uid]["starts"].sort()
-            cd_events_grouped_list.append(cd_events_grouped[uid])
-        context["events_grouped"] = sorted(
-            cd_events_grouped_list, key=lambda event: event["start_d"]
+        with transaction.atomic():
+            stale_uids = list(changed_uids | removed_uids)
+            for i in range(0, len(stale_uids), 500):
+                self.occurrences.filter(uid__in=stale_uids[i : i + 500]).delete()
+            self.occurrences.filter(end__lte=horizon_start).delete()
+            self.occurrences.filter(start__gte=horizon_end).delete()
+            IcalendarOccurrence.objects.bulk_create(occurrences, batch_size=500)
+
+        logger.info(
+            "Updated occurrences for %s: %s events added or changed, %s removed",
+            self.slug,
+            len(changed_uids),
+            len(removed_uids),
         )
 
+        self.occurrences_start = horizon_start
+        self.occurrences_end = horizon_end
+
+    def get_occurrence_page(self, request, context):
+        """
+        Returns a page of events for the calendar view, and adds the paging cursors to the context
+        Without a cursor, the page starts calendar_page_past_days before now.  With ?after= or ?before=, the page follows or precedes the cursor.
+        Only a bounded window around the page is ever expanded: calendar_page_past_days before and calendar_page_future_days after
+        These and calendar_page_size can be set in settings.WEBIKWA
+        The previous page is only linked if it has an event, and the next page if this page is full
+        """
+        page_size = get_webikwa_setting("calendar_page_size", 100)
+        past = datetime.timedelta(days=get_webikwa_setting("calendar_page_past_days", 31))
+        future = datetime.timedelta(days=get_webikwa_setting("calendar_page_future_days", 366))
+
+        before = parse_occurrence_cursor(request.GET.get("before", ""))
+        after = parse_occurrence_cursor(request.GET.get("after", ""))
+        if before is not None:
+            window = (before[0] - past, before[0] + datetime.timedelta(seconds=1))
+        elif after is not None:
+            window = (after[0], after[0] + future)
+        else:
+            now = timezone.now()
+            window = (now - past, now + future)
+        page = events_page([self], window, page_size, after=after, before=before)
+
+        if page:
+            first = (page[0].start_dt, page[0].uid)
+            # a page after a cursor follows the event of the cursor.  Otherwise the previous page is read for one event
+            if after is not None or events_page(
+                [self], (first[0] - past, first[0] + datetime.timedelta(seconds=1)), 1, before=first
+            ):
+                context["events_before"] = get_occurrence_cursor(*first)
+                context["previous_page_query"] = urlencode({"before": context["events_before"]})
+            if len(page) == page_size:
+                context["events_after"] = get_occurrence_cursor(page[-1].start_dt, page[-1].uid)
+                context["next_page_query"] = urlencode({"after": context["events_after"]})
+
+        return page
+
+    def get_context(self, request):
+
+        context = super().get_context(request)
+
+        calendar_refs = [
+            {"slug": self.slug, "title": self.title, "stale_since": get_stale_since([self]).get(self.pk)}
+        ]
+
+        uid_input = request.GET.get("uid", "")
+        if uid_input:
+            context["events"] = uid_events(
+                self, uid_input, get_webikwa_setting("calendar_uid_occurrences", 10)
+            )
+            if context["events"]:
+                context["event"] = context["events"][0]
+        else:
+            context["events"] = self.get_occurrence_page(request, context)
+
+        context["events_grouped"] = group_events(context["events"])
+
         context["datetime_formats"] = {"date": "D Y M d", "time": "g:iA"}
         # if self.calendar_dt_format:
         #     dt_formats = self.calendar_dt_format.split('|')
@@ -1542,17 +2187,74 @@ class IcalendarPage(Page):
 
         context["calendar_refs"] = calendar_refs
 
-        caldate = datetime.date.today()
-        context["calendar_dates"] = [caldate]
-        for i in range(100):
-            caldate = caldate + datetime.timedelta(days=1)
-            context["calendar_dates"].append(caldate)
+        context["calendar_dates"] = DateRange(datetime.date.today(), 101)
 
         context["sidebars"] = get_sidebars(request)
 
         return context
 
 
+def get_fetch_options():
+    """
+    Returns the timeout and max_size for fetching calendar sources, which can be set in settings.WEBIKWA with
+    calendar_fetch_connect_timeout and calendar_fetch_read_timeout (seconds), and calendar_fetch_max_size (bytes)
+    """
+    return {
+        "timeout": (
+            get_webikwa_setting("calendar_fetch_connect_timeout", 5),
+            get_webikwa_setting("calendar_fetch_read_timeout", 30),
+        ),
+        "max_size": get_webikwa_setting("calendar_fetch_max_size", MAX_FEED_SIZE),
+    }
+
+
+def get_stale_since(calendars):
+    """
+    Returns {calendar pk: stale since} for the calendars whose sources are failing, and so are showing their last good data
+    """
+    return dict(
+        IcalendarFeed.objects.filter(icalendar__in=calendars, stale_since__isnull=False).values_list(
+            "icalendar", "stale_since"
+        )
+    )
+
+
+def refresh_icalendar_pages(pages, max_workers=8):
+    """
+    Refreshes the pages, fetching each distinct source once, with up to max_workers fetches at a time
+    A source is fetched conditionally only if all of its pages have the same ETag and Last-Modified
+    Pages which are being refreshed by another process, and pages whose sources have failed too many times in a row
+    are skipped
+    Returns {source: (the pages, the FeedResponse or exception, the seconds taken to fetch)}
+    """
+    with contextlib.ExitStack() as locks:
+        pages_by_source = {}
+        for page in pages:
+            if not locks.enter_context(page.refresh_lock(blocking=False)):
+                logger.info("Calendar %s is being refreshed by another process", page.slug)
+                continue
+            page.reload_feed()
+            if page.get_feed().is_circuit_open():
+                logger.info("Calendar source for %s is not fetched until %s", page.slug, page.get_feed().next_refresh_at)
+                continue
+            pages_by_source.setdefault(page.source, []).append(page)
+
+        sources = {}
+        for source, source_pages in pages_by_source.items():
+            validators = {(page.get_feed().etag, page.get_feed().last_modified) for page in source_pages}
+            sources[source] = validators.pop() if len(validators) == 1 else ("", "")
+
+        fetched = fetch_feeds(sources, max_workers, **get_fetch_options())
+        for source, source_pages in pages_by_source.items():
+            for page in source_pages:
+                page.refresh(fetched[source][0])
+
+    return {
+        source: (source_pages, fetched[source][0], fetched[source][1])
+        for source, source_pages in pages_by_source.items()
+    }
+
+
 class IcalendarEvent(Orderable, models.Model):
 
     def get_default_start():
@@ -1742,3 +2444,126 @@ class IcalendarBlockPage(Orderable, models.Model):
     panels = [
         FieldPanel("uid"),
     ]
+
+
+def get_empty_compressed_ical():
+    return zlib.compress(get_empty_ical().encode("utf-8"))
+
+
+class IcalendarFeed(models.Model):
+    """
+    The ics data and event snapshot of an IcalendarPage, kept out of the page table so that they're only read when needed
+    The data is stored compressed, and the event snapshot is stored as compressed json
+    """
+
+    icalendar = models.OneToOneField(
+        IcalendarPage, on_delete=models.CASCADE, primary_key=True, related_name="feed"
+    )
+    compressed_data = models.BinaryField(blank=True, default=get_empty_compressed_ical)
+    compressed_snapshot = models.BinaryField(blank=True, default=b"")
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    content_hash = models.CharField(
+        max_length=64, blank=True, help_text="The sha256 of the data"
+    )
+    next_refresh_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    failure_count = models.PositiveIntegerField(default=0)
+    stale_since = models.DateTimeField(
+        blank=True, null=True, help_text="When the source first failed since it was last fetched"
+    )
+    refreshed_at = models.DateTimeField(blank=True, null=True)
+
+    # the fields which are saved even if the data didn't change
+    STATE_FIELDS = [
+        "etag",
+        "last_modified",
+        "next_refresh_at",
+        "failure_count",
+        "stale_since",
+        "refreshed_at",
+    ]
+
+    def is_circuit_open(self):
+        """
+        Returns whether the source has failed too many times in a row to be fetched before its next refresh
+        """
+        return (
+            self.failure_count >= get_webikwa_setting("calendar_refresh_failure_threshold", 5)
+            and self.next_refresh_at is not None
+            and self.next_refresh_at > timezone.now()
+        )
+
+    @property
+    def data(self):
+        return zlib.decompress(bytes(self.compressed_data)).decode("utf-8")
+
+    @data.setter
+    def data(self, value):
+        self.compressed_data = zlib.compress(value.encode("utf-8"))
+
+    @property
+    def event_snapshot(self):
+        if not self.compressed_snapshot:
+            return {}
+        return json.loads(zlib.decompress(bytes(self.compressed_snapshot)))
+
+    @event_snapshot.setter
+    def event_snapshot(self, value):
+        self.compressed_snapshot = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+
+class IcalendarOccurrence(models.Model):
+    """
+    An occurrence of an event from an IcalendarPage, expanded ahead of time for a rolling horizon so that calendars can be queried by date
+    """
+
+    icalendar = models.ForeignKey(
+        IcalendarPage, on_delete=models.CASCADE, related_name="occurrences"
+    )
+    uid = models.CharField(max_length=255)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    all_day = models.BooleanField(default=False)
+    summary = models.TextField(blank=True)
+    description = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ("start",)
+        indexes = [
+            models.Index(fields=["icalendar", "start"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["icalendar", "uid", "start"], name="webikwa257_icalendaroccurrence_unique_start"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{ self.summary } ({ self.start })"
+
+    @classmethod
+    def from_values(cls, icalendar, values, tz):
+        return cls(
+            icalendar=icalendar,
+            uid=values["uid"],
+            start=to_datetime(values["start"], tz),
+            end=to_datetime(values["end"], tz),
+            all_day=not isinstance(values["start"], datetime.datetime),
+            summary=values["summary"],
+            description=values["description"],
+        )
+
+    def get_values(self, tz):
+        # the database returns UTC, so timed occurrences are converted back to local time for their dates
+        start = self.start.astimezone(tz)
+        end = self.end.astimezone(tz)
+        if self.all_day:
+            start = start.date()
+            end = end.date()
+        return {
+            "uid": self.uid,
+            "start": start,
+            "end": end,
+            "summary": self.summary,
+            "description": self.description,
+        }
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from wagtail.signals import page_published, page_unpublished, post_page_move
+
+from .models import SiteTemplateSettings, clear_sidebar_cache
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+@receiver(post_page_move)
+def clear_sidebars_on_page_change(sender, **kwargs):
+    clear_sidebar_cache()
+
+
+@receiver(post_save, sender=SiteTemplateSettings)
+def clear_sidebars_on_settings_change(sender, **kwargs):
+    clear_sidebar_cache()
@@ -1,11 +1,31 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import zoneinfo
+from unittest import mock
+
+import icalendar
+import recurring_ical_events
+import requests
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+from wagtail.images.tests.utils import get_test_image_file
+from wagtail.images.models import Image
 from wagtail.test.utils import WagtailPageTestCase
+from wagtail.test.utils.form_data import inline_formset, nested_form_data
 from wagtail.models import Site
 
-from webikwa257.models import ArticleIndexPage, ArticlePage, IcalendarIndexPage, RedirectPage, SidebarPage,\
-    IcalendarPage, IcalCombinerPage
+from webikwa257.calendar_engine import events, get_calendar_occurrences, iter_expanded_occurrences
+from webikwa257.feeds import FeedResponse, FeedTooLarge, feed_lock, fetch_feed
+from webikwa257.ical import SNAPSHOT_VERSION, CalendarEvent, DateRange, bucket_events_by_date, build_snapshot, get_data_uids, snapshot_to_calendar, to_datetime
+from webikwa257.models import ArticleIndexPage, ArticlePage, ArticlePageImage, ArticlePlacement, ArticlePlacementPage, ArticleStaticTagsIndexPage, IcalendarIndexPage, RedirectPage, SidebarPage,\
+    IcalendarPage, IcalendarBlockPage, IcalendarFeed, IcalendarLinkPage, IcalCombinerPage, IcalendarOccurrence, Author, SidebarArticlePage, SiteTemplateSettings, clear_sidebar_cache, get_sidebars, load_article_listing, refresh_icalendar_pages
 
 default_test_ics_source = "https://calendar.google.com/calendar/ical/c_029797f3540c28bde5137e22119757d392bf274ecfb24d3078e2f1c2777f9aea%40group.calendar.google.com/public/basic.ics"
 
@@ -47,6 +67,7 @@ class IcalendarTestCase(WagtailPageTestCase):
             source=settings.TEST_ICS_SOURCE if hasattr(settings, "TEST_ICS_SOURCE") else default_test_ics_source  
         )
         calendar_index.add_child(instance=python_calendar)
+        python_calendar.refresh()
 
         combiner = IcalCombinerPage(
             title="Main Calendars",
@@ -60,4 +81,766 @@ class IcalendarTestCase(WagtailPageTestCase):
             self.fail("Please add TEST_ICS_SUMMARIES to settings and include strings to search for")
         for test_summary in test_summaries:
             self.assertIn(test_summary, python_calendar.data)
-            
\ No newline at end of file
+            
+
+class SidebarTestCase(WagtailPageTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        root = ArticlePage.get_first_root_node()
+        cls.site = Site.objects.create(
+            hostname="testserver",
+            root_page=root,
+            is_default_site=True,
+            site_name="testserver",
+        )
+        cls.sidebar_left = SidebarPage(title="Left Sidebar", location="left")
+        root.add_child(instance=cls.sidebar_left)
+        cls.sidebar_right = SidebarPage(title="Right Sidebar", location="right")
+        root.add_child(instance=cls.sidebar_right)
+        cls.menu = SidebarArticlePage(title="Main Menu", body_md="- [home](/)")
+        cls.sidebar_left.add_child(instance=cls.menu)
+
+    def setUp(self):
+        clear_sidebar_cache()
+        SiteTemplateSettings.objects.create(site=self.site, show_leftbar=True)
+
+    def get_request(self):
+        request = RequestFactory().get("/")
+        request.site = self.site
+        return request
+
+    def test_sidebars_skip_hidden_locations(self):
+        sidebars = get_sidebars(self.get_request())
+        self.assertEqual([sidebar["location"] for sidebar in sidebars], ["left"])
+        self.assertEqual(sidebars[0]["children"][0]["title"], "Main Menu")
+
+    def test_sidebar_cache_cleared_on_publish(self):
+        get_sidebars(self.get_request())
+        extra = SidebarArticlePage(title="Extra", live=False)
+        self.sidebar_left.add_child(instance=extra)
+        self.assertEqual(len(get_sidebars(self.get_request())[0]["children"]), 1)
+        extra.save_revision().publish()
+        self.assertEqual(len(get_sidebars(self.get_request())[0]["children"]), 2)
+
+
+class ArticleListingTestCase(WagtailPageTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        root = ArticlePage.get_first_root_node()
+        cls.site = Site.objects.create(
+            hostname="testserver",
+            root_page=root,
+            is_default_site=True,
+            site_name="testserver",
+        )
+        cls.articles = ArticleIndexPage(title="Articles", page_size=2)
+        root.add_child(instance=cls.articles)
+        published = timezone.now()
+        cls.article_pages = []
+        for i in range(5):
+            article = ArticlePage(title="Article {}".format(i))
+            cls.articles.add_child(instance=article)
+            article.tags.add("news" if i % 2 else "events")
+            article.save()
+            # the last two articles are published at the same time
+            ArticlePage.objects.filter(pk=article.pk).update(
+                last_published_at=published + datetime.timedelta(minutes=min(i, 3))
+            )
+            cls.article_pages.append(article)
+
+    def setUp(self):
+        clear_sidebar_cache()
+
+    def get_request(self, path="/"):
+        request = RequestFactory().get(path)
+        request.site = self.site
+        return request
+
+    def get_titles(self, context):
+        return [article.title for article in context["articlepages"]]
+
+    def test_index_pages_by_cursor(self):
+        context = self.articles.get_context(self.get_request())
+        self.assertEqual(self.get_titles(context), ["Article 4", "Article 3"])
+        self.assertNotIn("previous_page_query", context)
+        self.assertNotIn("previous_page_url", context)
+        self.assertEqual(context["next_page_url"], "/articles/?" + context["next_page_query"])
+        context = self.articles.get_context(self.get_request("/?" + context["next_page_query"]))
+        self.assertEqual(self.get_titles(context), ["Article 2", "Article 1"])
+        self.assertEqual(context["previous_page_url"], "/articles/?" + context["previous_page_query"])
+        last_context = self.articles.get_context(self.get_request("/?" + context["next_page_query"]))
+        self.assertEqual(self.get_titles(last_context), ["Article 0"])
+        self.assertNotIn("next_page_query", last_context)
+        context = self.articles.get_context(self.get_request("/?" + context["previous_page_query"]))
+        self.assertEqual(self.get_titles(context), ["Article 4", "Article 3"])
+
+    def test_index_pages_by_tag(self):
+        context = self.articles.get_context(self.get_request("/?tag=events"))
+        self.assertEqual(self.get_titles(context), ["Article 0", "Article 2"])
+        self.assertIn("tag=events", context["next_page_query"])
+        context = self.articles.get_context(self.get_request("/?" + context["next_page_query"]))
+        self.assertEqual(self.get_titles(context), ["Article 4"])
+
+    def test_static_tags_index_groups_articles(self):
+        static_tags = ArticleStaticTagsIndexPage(
+            title="Tags",
+            included_tag_names_string="events;missing, news",
+            tag_titles_string="Events",
+            group_titles_string="First,Second",
+        )
+        self.articles.add_child(instance=static_tags)
+        with CaptureQueriesContext(connection) as queries:
+            context = static_tags.get_context(self.get_request())
+        self.assertEqual(
+            len([query for query in queries if 'FROM "webikwa257_articlepagetag"' in query["sql"]]), 1
+        )
+
+        groups = context["article_page_groups"]
+        self.assertEqual([group["group_title"] for group in groups], ["First", "Second"])
+        events_set, = groups[0]["article_page_sets"]
+        self.assertEqual(events_set["title"], "Events")
+        self.assertEqual(
+            [article.title for article in events_set["article_pages"]],
+            ["Article 4", "Article 2", "Article 0"],
+        )
+        news_set, = groups[1]["article_page_sets"]
+        self.assertEqual((news_set["tagname"], news_set["title"]), ("news", "news"))
+        self.assertEqual(
+            [article.title for article in news_set["article_pages"]],
+            ["Article 3", "Article 1"],
+        )
+
+    def test_placement_page_zones(self):
+        placement_page = ArticlePlacementPage(title="Placements", zone_qty=2)
+        self.articles.add_child(instance=placement_page)
+        for article, zone in zip(self.article_pages, [1, 2, 9, 1]):
+            ArticlePlacement.objects.create(article=article, page=placement_page, zone=zone)
+        ArticlePlacement.objects.create(
+            article=self.article_pages[4],
+            page=placement_page,
+            zone=1,
+            expiration_date=datetime.date.today() - datetime.timedelta(days=1),
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            context = placement_page.get_context(self.get_request())
+        self.assertEqual(
+            len([query for query in queries if "articleplacement" in query["sql"]]), 1
+        )
+        self.assertEqual(
+            [[placement.article.title for placement in zone["placements"]] for zone in context["zones"]],
+            [[], ["Article 3", "Article 0"], ["Article 2", "Article 1"]],
+        )
+
+    def test_load_article_listing(self):
+        image = Image.objects.create(title="Test", file=get_test_image_file())
+        author = Author.objects.create(name="Writer", author_image=image)
+        for article in self.article_pages[:2]:
+            article.authors.add(author)
+            article.save()
+        ArticlePageImage.objects.create(page=self.article_pages[0], image=image, display_with_summary=True)
+        featured = ArticlePageImage.objects.create(page=self.article_pages[0], image=image, is_featured=True)
+        first = ArticlePageImage.objects.create(page=self.article_pages[1], image=image)
+        self.article_pages[2].tags.add("_hidden")
+        for article in self.article_pages[:3]:
+            article.save()
+
+        # the number of queries doesn't depend on the number of articles
+        with self.assertNumQueries(6):
+            articles = load_article_listing(ArticlePage.objects.order_by("pk"))
+        with self.assertNumQueries(0):
+            self.assertEqual([article.featured_image() for article in articles[:3]], [featured, first, None])
+            self.assertEqual(len(articles[0].summary_images), 1)
+            self.assertEqual([author.name for author in articles[1].authors.all()], ["Writer"])
+            self.assertEqual(articles[1].authors.all()[0].author_image, image)
+            self.assertEqual([tag.name for tag in articles[2].visible_tags], ["events"])
+
+    def test_featured_image_is_set_on_save(self):
+        image = Image.objects.create(title="Test", file=get_test_image_file())
+        article = self.article_pages[0]
+        first = ArticlePageImage.objects.create(page=article, image=image, sort_order=0)
+        featured = ArticlePageImage.objects.create(page=article, image=image, sort_order=1)
+        article.save()
+        self.assertEqual(ArticlePage.objects.get(pk=article.pk).featured_image(), first)
+
+        featured.is_featured = True
+        featured.save()
+        # a draft revision doesn't change the featured image until it's published
+        article.save_revision()
+        self.assertEqual(ArticlePage.objects.get(pk=article.pk).featured_image(), first)
+        article.save_revision().publish()
+        self.assertEqual(ArticlePage.objects.get(pk=article.pk).featured_image(), featured)
+
+        featured.delete()
+        self.assertIsNone(ArticlePage.objects.get(pk=article.pk).featured_image())
+
+
+def get_test_ics():
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    return f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//webikwa257//tests//EN
+BEGIN:VEVENT
+UID:weekly@tests
+DTSTART;TZID=America/New_York:20240101T100000
+DTEND;TZID=America/New_York:20240101T110000
+RRULE:FREQ=WEEKLY
+SUMMARY:Weekly Meeting
+END:VEVENT
+BEGIN:VEVENT
+UID:once@tests
+DTSTART;VALUE=DATE:{ tomorrow.strftime("%Y%m%d") }
+DTEND;VALUE=DATE:{ (tomorrow + datetime.timedelta(days=2)).strftime("%Y%m%d") }
+SUMMARY:Conference
+DESCRIPTION:Two days
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def get_outlook_test_ics():
+    return """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Microsoft Corporation//Outlook 16.0 MIMEDIR//EN
+BEGIN:VTIMEZONE
+TZID:Eastern Standard Time
+BEGIN:STANDARD
+DTSTART:16011104T020000
+RRULE:FREQ=YEARLY;BYDAY=1SU;BYMONTH=11
+TZOFFSETFROM:-0400
+TZOFFSETTO:-0500
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:16010311T020000
+RRULE:FREQ=YEARLY;BYDAY=2SU;BYMONTH=3
+TZOFFSETFROM:-0500
+TZOFFSETTO:-0400
+END:DAYLIGHT
+END:VTIMEZONE
+BEGIN:VEVENT
+UID:outlook@tests
+DTSTART;TZID=Eastern Standard Time:20240101T100000
+DTEND;TZID=Eastern Standard Time:20240101T110000
+RRULE:FREQ=WEEKLY
+EXDATE;TZID=Eastern Standard Time:20240318T100000,20240401T100000
+SUMMARY:Outlook Meeting
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def get_feed_response(text="", status_code=200, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = text.encode("utf-8")
+    response._content_consumed = True
+    return response
+
+
+class CalendarTestCase(WagtailPageTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        root = ArticlePage.get_first_root_node()
+        cls.site = Site.objects.create(
+            hostname="testserver",
+            root_page=root,
+            is_default_site=True,
+            site_name="testserver",
+        )
+        cls.calendar_index = IcalendarIndexPage(title="Calendar Index")
+        root.add_child(instance=cls.calendar_index)
+        cls.calendar = IcalendarPage(title="Local Events", data=get_test_ics())
+        cls.calendar_index.add_child(instance=cls.calendar)
+        cls.sidebar = SidebarPage(title="Left Sidebar", location="left")
+        root.add_child(instance=cls.sidebar)
+        cls.combiner = IcalCombinerPage(
+            title="Main Calendars",
+            calendars=[cls.calendar],
+            ical_start_span_count="-1,60,5",
+        )
+        cls.sidebar.add_child(instance=cls.combiner)
+
+    def get_request(self, path="/"):
+        request = RequestFactory().get(path)
+        request.site = self.site
+        return request
+
+    def test_save_stores_event_snapshot(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        self.assertEqual(calendar.event_snapshot["version"], SNAPSHOT_VERSION)
+        self.assertEqual(
+            set(calendar.event_snapshot["events"]), {"weekly@tests", "once@tests"}
+        )
+        self.assertEqual(
+            calendar.event_snapshot["events"]["weekly@tests"]["rrule"], ["FREQ=WEEKLY"]
+        )
+
+    def test_combiner_events(self):
+        context = self.combiner.get_context(self.get_request())
+        summaries = [str(event.summary) for event in context["events"]]
+        self.assertEqual(len(summaries), 5)
+        self.assertIn("Conference", summaries)
+        self.assertEqual(summaries.count("Weekly Meeting"), 4)
+
+    def test_data_is_read_from_feed(self):
+        self.assertIn("weekly@tests", IcalendarFeed.objects.get(icalendar=self.calendar).data)
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        with self.assertNumQueries(1):
+            self.assertIn("weekly@tests", calendar.data)
+        with self.assertNumQueries(0):
+            calendar.parse_data()
+
+    def test_draft_data_is_kept_with_the_revision(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        calendar.data = get_test_ics().replace("Conference", "Summit")
+        revision = calendar.save_revision()
+        self.assertNotIn("Summit", IcalendarFeed.objects.get(icalendar=calendar).data)
+        self.assertNotIn("event_snapshot", revision.content)
+        live_calendar = IcalendarPage.objects.get(pk=calendar.pk)
+        self.assertEqual(live_calendar.event_snapshot["events"]["once@tests"]["summary"], "Conference")
+
+        self.assertIn("Summit", revision.as_object().data)
+        revision.publish()
+        self.assertIn("Summit", IcalendarFeed.objects.get(icalendar=calendar).data)
+        live_calendar = IcalendarPage.objects.get(pk=calendar.pk)
+        self.assertEqual(live_calendar.event_snapshot["events"]["once@tests"]["summary"], "Summit")
+        self.assertNotIn("data", live_calendar.save_revision().content)
+
+    def test_feed_data_is_compressed(self):
+        feed = IcalendarFeed.objects.get(icalendar=self.calendar)
+        self.assertLess(len(feed.compressed_data), len(feed.data))
+        feed.data = "SUMMARY:Café ☕\n" * 100
+        self.assertEqual(feed.data, "SUMMARY:Café ☕\n" * 100)
+
+    def get_calendar_form(self, calendar, **values):
+        form_data = {
+            "title": calendar.title,
+            "slug": calendar.slug,
+            "source": calendar.source,
+            "refresh_interval": "60",
+            "data": calendar.data,
+            "delete_stale_links_blocks": "on",
+            "ical_events": inline_formset([]),
+            "uid_links": inline_formset([]),
+            "uid_blocks": inline_formset([]),
+        }
+        form_data.update(values)
+        form_class = IcalendarPage.get_edit_handler().get_form_class()
+        return form_class(
+            nested_form_data(form_data), instance=calendar, parent_page=self.calendar_index, for_user=None
+        )
+
+    def test_unchanged_form_data_is_not_written(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        form = self.get_calendar_form(calendar, data=calendar.data.replace("\n", "\r\n") + "\r\n")
+        self.assertTrue(form.is_valid(), form.errors)
+        with mock.patch.object(IcalendarPage, "rebuild_event_snapshot") as rebuild:
+            form.save(commit=False).save()
+        rebuild.assert_not_called()
+
+        form = self.get_calendar_form(calendar, data=calendar.data.replace("Conference", "Summit"))
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save(commit=False).save()
+        self.assertIn("Summit", IcalendarFeed.objects.get(icalendar=calendar).data)
+
+        sourced = IcalendarPage(title="Remote Events", source="https://example.com/calendar.ics", data=get_test_ics())
+        self.calendar_index.add_child(instance=sourced)
+        form = self.get_calendar_form(sourced, data="")
+        self.assertTrue(form.fields["data"].disabled)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save(commit=False).save()
+        self.assertIn("weekly@tests", IcalendarFeed.objects.get(icalendar=sourced).data)
+
+    def test_copied_calendar_keeps_its_data(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        copy = calendar.copy(to=self.calendar_index, update_attrs={"title": "Copied Events", "slug": "copied-events"})
+        copy = IcalendarPage.objects.get(pk=copy.pk)
+        self.assertEqual(copy.data, calendar.data)
+        self.assertEqual(set(copy.event_snapshot["events"]), {"weekly@tests", "once@tests"})
+        self.assertEqual(copy.occurrences.count(), calendar.occurrences.count())
+        self.assertEqual(IcalendarFeed.objects.get(icalendar=calendar).data, calendar.data)
+
+    def test_event_snapshot_is_kept_with_the_feed(self):
+        feed = IcalendarFeed.objects.get(icalendar=self.calendar)
+        self.assertIn("weekly@tests", feed.event_snapshot["events"])
+        self.assertLess(len(feed.compressed_snapshot), len(json.dumps(feed.event_snapshot)))
+        self.assertNotIn("event_snapshot", [field.name for field in IcalendarPage._meta.get_fields()])
+        with self.assertNumQueries(1):
+            calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(calendar.event_snapshot, feed.event_snapshot)
+
+    def test_unchanged_source_is_not_parsed(self):
+        calendar = IcalendarPage(title="Remote Events", source="https://example.com/calendar.ics")
+        response = get_feed_response(get_test_ics(), headers={"ETag": '"v1"'})
+        with mock.patch("webikwa257.feeds.requests.get", return_value=response) as get:
+            self.calendar_index.add_child(instance=calendar)
+            get.assert_not_called()
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        self.assertEqual(IcalendarFeed.objects.get(icalendar=calendar).etag, '"v1"')
+        self.assertIn("weekly@tests", IcalendarPage.objects.get(pk=calendar.pk).event_snapshot["events"])
+
+        with mock.patch(
+            "webikwa257.feeds.requests.get", return_value=get_feed_response(status_code=304)
+        ) as get, mock.patch.object(IcalendarPage, "rebuild_event_snapshot") as rebuild:
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        self.assertEqual(get.call_args.kwargs["headers"]["If-None-Match"], '"v1"')
+        rebuild.assert_not_called()
+
+        with mock.patch(
+            "webikwa257.feeds.requests.get", return_value=get_feed_response(get_test_ics())
+        ), mock.patch.object(IcalendarPage, "rebuild_event_snapshot") as rebuild:
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        rebuild.assert_not_called()
+
+    def test_refresh_backs_off_after_failures(self):
+        calendar = IcalendarPage(title="Remote Events", source="https://example.com/calendar.ics")
+        self.calendar_index.add_child(instance=calendar)
+        self.assertLessEqual(IcalendarFeed.objects.get(icalendar=calendar).next_refresh_at, timezone.now())
+        with mock.patch(
+            "webikwa257.feeds.requests.get", side_effect=requests.ConnectionError
+        ):
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        feed = IcalendarFeed.objects.get(icalendar=calendar)
+        self.assertEqual(feed.failure_count, 2)
+        self.assertGreater(feed.next_refresh_at, timezone.now() + datetime.timedelta(minutes=239))
+
+    @override_settings(WEBIKWA={"calendar_refresh_failure_threshold": 2})
+    def test_failing_source_keeps_last_good_data(self):
+        calendar = IcalendarPage(title="Remote Events", source="https://example.com/calendar.ics")
+        self.calendar_index.add_child(instance=calendar)
+        with mock.patch("webikwa257.feeds.requests.get", return_value=get_feed_response(get_test_ics())):
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+
+        with mock.patch(
+            "webikwa257.feeds.requests.get", return_value=get_feed_response("Not Found", status_code=404)
+        ) as get:
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        self.assertEqual(get.call_count, 2)
+        calendar = IcalendarPage.objects.get(pk=calendar.pk)
+        self.assertIn("weekly@tests", calendar.event_snapshot["events"])
+        self.assertIsNotNone(calendar.get_feed().stale_since)
+        context = calendar.get_context(self.get_request())
+        self.assertEqual(context["calendar_refs"][0]["stale_since"], calendar.get_feed().stale_since)
+
+    def test_refresh_is_locked_and_coalesced(self):
+        calendar = IcalendarPage(title="Remote Events", source="https://example.com/calendar.ics")
+        self.calendar_index.add_child(instance=calendar)
+        with mock.patch(
+            "webikwa257.feeds.requests.Session.get", return_value=get_feed_response(get_test_ics())
+        ) as get:
+            with calendar.refresh_lock():
+                self.assertEqual(refresh_icalendar_pages([calendar]), {})
+            get.assert_not_called()
+
+        IcalendarFeed.objects.filter(pk=calendar.pk).update(
+            refreshed_at=timezone.now() + datetime.timedelta(minutes=1)
+        )
+        with mock.patch("webikwa257.feeds.requests.get") as get:
+            IcalendarPage.objects.get(pk=calendar.pk).refresh()
+        get.assert_not_called()
+
+    def test_writers_lock_the_page_row(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        calendar.get_feed()
+        IcalendarFeed.objects.filter(pk=calendar.pk).update(etag='"v2"')
+        lock_for_update = IcalendarPage.lock_for_update
+        with mock.patch("webikwa257.models.feed_lock", wraps=feed_lock) as file_lock, mock.patch.object(
+            IcalendarPage, "lock_for_update", autospec=True, side_effect=lock_for_update
+        ) as row_lock:
+            calendar.save()
+            call_command("rebuild_calendars", str(calendar.pk), "--all", stdout=io.StringIO())
+            self.assertEqual(IcalendarFeed.objects.get(pk=calendar.pk).etag, '"v2"')
+            calendar.refresh(FeedResponse(None, '"v3"', ""))
+        # the file lock is only taken to fetch, so a writer holding the page row never waits for it
+        file_lock.assert_not_called()
+        self.assertEqual(row_lock.call_count, 2)
+        self.assertEqual(IcalendarFeed.objects.get(pk=calendar.pk).etag, '"v3"')
+
+    def test_feed_size_is_limited(self):
+        with mock.patch("webikwa257.feeds.requests.get", return_value=get_feed_response(get_test_ics())):
+            with self.assertRaises(FeedTooLarge):
+                fetch_feed("https://example.com/calendar.ics", max_size=100)
+
+    def test_refresh_fetches_shared_source_once(self):
+        pages = []
+        for title in ["Remote Events", "Same Remote Events"]:
+            page = IcalendarPage(title=title, source="https://example.com/calendar.ics")
+            self.calendar_index.add_child(instance=page)
+            pages.append(page)
+        response = get_feed_response(get_test_ics())
+        with mock.patch("webikwa257.feeds.requests.Session.get", return_value=response) as get:
+            refreshed = refresh_icalendar_pages(pages)
+        get.assert_called_once()
+        self.assertEqual(refreshed["https://example.com/calendar.ics"][0], pages)
+        for page in pages:
+            self.assertIn("weekly@tests", IcalendarPage.objects.get(pk=page.pk).event_snapshot["events"])
+
+    def test_get_data_uids(self):
+        data = get_test_ics().replace("UID:weekly@tests", "UID:weekly@tests-with-a-long\r\n  uid")
+        self.assertEqual(get_data_uids(data), {"weekly@tests-with-a-long uid", "once@tests"})
+
+    def test_save_deletes_stale_links_and_blocks(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        calendar.uid_links.add(IcalendarLinkPage(uid="weekly@tests", url="/weekly/"))
+        calendar.uid_links.add(IcalendarLinkPage(uid="gone@tests", url="/gone/"))
+        calendar.uid_blocks.add(IcalendarBlockPage(uid="gone@tests"))
+        calendar.save()
+        self.assertEqual(list(IcalendarLinkPage.objects.values_list("uid", flat=True)), ["weekly@tests"])
+        self.assertFalse(IcalendarBlockPage.objects.exists())
+
+    def test_save_stores_occurrences(self):
+        occurrences = IcalendarOccurrence.objects.filter(icalendar=self.calendar)
+        self.assertEqual(occurrences.filter(uid="once@tests").count(), 1)
+        self.assertTrue(occurrences.get(uid="once@tests").all_day)
+        self.assertGreater(occurrences.filter(uid="weekly@tests").count(), 50)
+
+    def test_occurrence_horizon_covers_combiners_and_rolls(self):
+        combiner = IcalCombinerPage(title="Long", calendars=[self.calendar], ical_start_span_count="-1,800")
+        self.sidebar.add_child(instance=combiner)
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        self.assertTrue(calendar.is_horizon_stale())
+        calendar.refresh(FeedResponse(None, "", ""))
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        self.assertGreater(calendar.occurrences_end, timezone.now() + datetime.timedelta(days=800))
+        self.assertFalse(calendar.is_horizon_stale())
+
+        later = timezone.now() + datetime.timedelta(days=30)
+        with mock.patch("django.utils.timezone.now", return_value=later):
+            self.assertTrue(calendar.is_horizon_stale())
+            calendar.refresh(FeedResponse(None, "", ""))
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        self.assertGreater(calendar.occurrences_end, later + datetime.timedelta(days=800))
+        self.assertGreater(
+            calendar.occurrences.latest("start").start, later + datetime.timedelta(days=790)
+        )
+        self.assertFalse(calendar.occurrences.filter(end__lte=calendar.occurrences_start).exists())
+
+    def test_shrunk_horizon_is_pruned_before_it_rolls(self):
+        combiner = IcalCombinerPage(title="Long", calendars=[self.calendar], ical_start_span_count="-1,800")
+        self.sidebar.add_child(instance=combiner)
+        IcalendarPage.objects.get(pk=self.calendar.pk).save()
+
+        combiner.unpublish()
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        calendar.data = calendar.data.replace("SUMMARY:Conference", "SUMMARY:Summit")
+        calendar.save()
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        self.assertLess(calendar.occurrences_end, timezone.now() + datetime.timedelta(days=400))
+        self.assertFalse(calendar.occurrences.filter(start__gte=calendar.occurrences_end).exists())
+
+        combiner.save_revision().publish()
+        calendar.refresh(FeedResponse(None, "", ""))
+        starts = list(calendar.occurrences.values_list("uid", "start"))
+        self.assertEqual(len(starts), len(set(starts)))
+        self.assertGreater(max(start for uid, start in starts), timezone.now() + datetime.timedelta(days=790))
+
+    def test_combiner_events_past_stored_horizon(self):
+        combiner = IcalCombinerPage(calendars=[self.calendar], ical_start_span_count="-1,800")
+        context = combiner.get_context(self.get_request())
+        last_start = context["events"][-1].start_dt
+        self.assertGreater(last_start, self.calendar.occurrences_end)
+        self.assertEqual(len(context["events"]), len(set(event.start_dt for event in context["events"])))
+
+    def test_save_updates_only_changed_occurrences(self):
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        weekly_ids = set(
+            calendar.occurrences.filter(uid="weekly@tests").values_list("pk", flat=True)
+        )
+        calendar.data = calendar.data.replace("SUMMARY:Conference", "SUMMARY:Summit")
+        calendar.save()
+        self.assertEqual(calendar.occurrences.get(uid="once@tests").summary, "Summit")
+        self.assertEqual(
+            weekly_ids,
+            set(calendar.occurrences.filter(uid="weekly@tests").values_list("pk", flat=True)),
+        )
+
+    def test_combiner_merges_expanded_calendars(self):
+        unstored = IcalendarPage.objects.get(pk=self.calendar.pk)
+        unstored.occurrences_start = None
+        occurrences = get_calendar_occurrences(
+            [self.calendar, unstored],
+            timezone.now(),
+            timezone.now() + datetime.timedelta(days=3660),
+            count=6,
+        )
+        self.assertEqual(len(occurrences), 6)
+        tz = timezone.get_current_timezone()
+        starts = [to_datetime(values["start"], tz) for calendar, values in occurrences]
+        self.assertEqual(starts, sorted(starts))
+
+    def test_stored_and_expanded_events_have_the_same_dates(self):
+        calendar = IcalendarPage(
+            title="Evening Events",
+            data=get_test_ics().replace("T100000", "T210000").replace("T110000", "T223000"),
+        )
+        self.calendar_index.add_child(instance=calendar)
+        unstored = IcalendarPage.objects.get(pk=calendar.pk)
+        unstored.occurrences_start = None
+        window = (timezone.now(), timezone.now() + datetime.timedelta(days=30))
+        stored_events = events([IcalendarPage.objects.get(pk=calendar.pk)], window)
+        expanded_events = events([unstored], window)
+        self.assertEqual(
+            [(event.start_d, event.start_dt) for event in stored_events],
+            [(event.start_d, event.start_dt) for event in expanded_events],
+        )
+        weekly = [event for event in stored_events if event.uid == "weekly@tests"]
+        self.assertTrue(weekly)
+        self.assertTrue(all(event.start.hour == 21 for event in weekly))
+
+    def test_engine_groups_and_blocks_events(self):
+        window = (timezone.now(), timezone.now() + datetime.timedelta(days=60))
+        groups = events([self.calendar], window, group_by_uid=True)
+        self.assertEqual([group.uid for group in groups].count("weekly@tests"), 1)
+        weekly = next(group for group in groups if group.uid == "weekly@tests")
+        self.assertGreaterEqual(len(weekly.starts), 8)
+
+        calendar = IcalendarPage.objects.get(pk=self.calendar.pk)
+        calendar.uid_blocks.add(IcalendarBlockPage(uid="once@tests"))
+        calendar.save()
+        self.assertNotIn("once@tests", [event.uid for event in events([calendar], window)])
+
+    def test_combiner_groups_the_whole_window(self):
+        context = self.combiner.get_context(self.get_request())
+        self.assertEqual(len(context["events"]), 5)
+        groups = {group.uid: group for group in context["events_grouped"]}
+        self.assertEqual(set(groups), {"weekly@tests", "once@tests"})
+        self.assertGreaterEqual(len(groups["weekly@tests"].starts), 8)
+
+        window = (timezone.now(), timezone.now() + datetime.timedelta(days=60))
+        first, = events([self.calendar], window, 1, group_by_uid=True)
+        self.assertEqual(first.uid, events([self.calendar], window, 1)[0].uid)
+        self.assertEqual(
+            len(first.starts), len([event for event in events([self.calendar], window) if event.uid == first.uid])
+        )
+
+        unstored = IcalendarPage.objects.get(pk=self.calendar.pk)
+        unstored.occurrences_start = None
+        with mock.patch(
+            "webikwa257.calendar_engine.iter_expanded_occurrences", wraps=iter_expanded_occurrences
+        ) as expand:
+            unstored_first, = events([unstored], window, 1, group_by_uid=True)
+        self.assertTrue(expand.call_args_list[0].kwargs["lazy"])
+        self.assertEqual(unstored_first.starts, first.starts)
+
+    def test_combiner_query_count_is_constant(self):
+        request = self.get_request()
+        combiner = IcalCombinerPage.objects.get(pk=self.combiner.pk)
+        combiner.get_context(request)
+        with CaptureQueriesContext(connection) as one_calendar:
+            combiner.get_context(request)
+
+        calendar = IcalendarPage(title="More Events", data=get_test_ics())
+        self.calendar_index.add_child(instance=calendar)
+        combiner.calendars.add(calendar)
+        combiner.save()
+        combiner = IcalCombinerPage.objects.get(pk=self.combiner.pk)
+        combiner.get_context(request)
+        with CaptureQueriesContext(connection) as two_calendars:
+            combiner.get_context(request)
+        self.assertEqual(len(one_calendar), len(two_calendars))
+
+    def test_combiner_grid_pages_by_month(self):
+        combiner = IcalCombinerPage(
+            calendars=[self.calendar], ical_start_span_count="0,90,5", calendar_format="GRID"
+        )
+        next_month = (datetime.date.today().replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        context = combiner.get_context(self.get_request(next_month.strftime("/?month=%Y-%m")))
+        self.assertEqual(context["calendar_month"], next_month)
+        self.assertEqual(context["calendar_month_dates"][0].date(), next_month)
+        self.assertEqual(len(context["calendar_dates"]), 91)
+        self.assertEqual(len(context["calendar_days"]), len(context["calendar_month_dates"]))
+        weekly = [event for event in context["events"] if event.uid == "weekly@tests"]
+        self.assertIn(len(weekly), [4, 5])
+        self.assertTrue(all(event.start_d.month == next_month.month for event in weekly))
+
+    @override_settings(WEBIKWA={"calendar_page_size": 3})
+    def test_calendar_page_is_paged(self):
+        context = self.calendar.get_context(self.get_request())
+        self.assertEqual(len(context["events"]), 3)
+        next_context = self.calendar.get_context(self.get_request("/?" + context["next_page_query"]))
+        self.assertEqual(len(next_context["events"]), 3)
+        self.assertGreater(next_context["events"][0].start_dt, context["events"][-1].start_dt)
+        previous_context = self.calendar.get_context(self.get_request("/?" + next_context["previous_page_query"]))
+        self.assertEqual(
+            [event.start_dt for event in previous_context["events"]],
+            [event.start_dt for event in context["events"]],
+        )
+
+    def test_calendar_page_links_previous_page_only_with_events(self):
+        calendar = IcalendarPage(title="Upcoming Events", data=get_test_ics().replace("RRULE:FREQ=WEEKLY\n", ""))
+        self.calendar_index.add_child(instance=calendar)
+        context = calendar.get_context(self.get_request())
+        self.assertEqual([event.uid for event in context["events"]], ["once@tests"])
+        self.assertNotIn("previous_page_query", context)
+        self.assertNotIn("next_page_query", context)
+
+        context = self.calendar.get_context(self.get_request())
+        self.assertIn("previous_page_query", context)
+
+    def test_calendar_page_single_event(self):
+        context = self.calendar.get_context(self.get_request("/?uid=weekly@tests"))
+        self.assertEqual(context["event"].uid, "weekly@tests")
+        self.assertEqual({event.uid for event in context["events"]}, {"weekly@tests"})
+        self.assertEqual(len(context["events"]), 10)
+
+
+class DateRangeTestCase(SimpleTestCase):
+
+    def test_date_range(self):
+        dates = DateRange(datetime.date(2024, 1, 30), 35)
+        self.assertEqual(len(dates), 35)
+        self.assertEqual(dates[-1], datetime.date(2024, 3, 4))
+        self.assertEqual(list(dates[1:3]), [datetime.date(2024, 1, 31), datetime.date(2024, 2, 1)])
+        self.assertEqual(dates.months(), [(2024, 1), (2024, 2), (2024, 3)])
+        february = dates.for_month(2024, 2)
+        self.assertEqual((february[0], len(february)), (datetime.date(2024, 2, 1), 29))
+
+    def test_bucket_events_by_date(self):
+        tz = zoneinfo.ZoneInfo("America/New_York")
+        dates = DateRange(datetime.date(2024, 3, 1), 5)
+        conference = CalendarEvent(
+            "conference", "", "", datetime.date(2024, 2, 28), datetime.date(2024, 3, 3), "", "", None, tz
+        )
+        meeting = CalendarEvent(
+            "meeting",
+            "",
+            "",
+            datetime.datetime(2024, 3, 4, 15, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2024, 3, 4, 16, tzinfo=datetime.timezone.utc),
+            "",
+            "",
+            None,
+            tz,
+        )
+        days = bucket_events_by_date([conference, meeting], dates, tz)
+        self.assertEqual(
+            [len(day["events"]) for day in days], [1, 1, 0, 1, 0]
+        )
+
+    def test_snapshot_keeps_custom_vtimezone(self):
+        snapshot = build_snapshot(icalendar.Calendar.from_ical(get_outlook_test_ics()))
+        ical_calendar = snapshot_to_calendar(snapshot)
+        starts = [
+            ical_event["DTSTART"].dt.astimezone(datetime.timezone.utc)
+            for ical_event in recurring_ical_events.of(ical_calendar).between(
+                datetime.date(2024, 3, 1), datetime.date(2024, 4, 10)
+            )
+        ]
+        # 10:00 Eastern is 15:00 UTC before the change to daylight saving time on March 10th, and 14:00 after it
+        self.assertEqual(
+            starts,
+            [
+                datetime.datetime(2024, 3, 4, 15, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2024, 3, 11, 14, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2024, 3, 25, 14, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2024, 4, 8, 14, tzinfo=datetime.timezone.utc),
+            ],
+        )